@@ -0,0 +1,124 @@
+"""
+Download throughput benchmark of the EGA download path
+
+Serves a random file from a local HTTP server supporting range requests, and downloads it with
+download_ticket for several block sizes, next to a loop writing every chunk of iter_content as the
+first versions of download_request did. Both compute the MD5 of the file.
+
+	python benchmarks/bench_download.py [--size-mb 256] [--workers 1] [--block-sizes 65536,1048576,4194304,16777216]
+"""
+
+import argparse
+import hashlib
+import os
+import re
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+try:
+	from http.server import BaseHTTPRequestHandler, HTTPServer
+	from socketserver import ThreadingMixIn
+except ImportError:
+	from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+	from SocketServer import ThreadingMixIn
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from icgconnect.ega import download
+from icgconnect.utils import http_utils
+
+CHUNK_SIZE = 1024 * 1024 # bytes written to the socket at a time by the server
+
+class _Server(ThreadingMixIn, HTTPServer):
+	daemon_threads = True
+
+def serve(data):
+	""" Serve bytes on a local port, with support of range requests
+
+		Args:
+			data (bytes):	The content of the file
+
+		Returns:
+			str:	The URL of the server
+	"""
+	view = memoryview(data)
+
+	class Handler(BaseHTTPRequestHandler):
+		protocol_version = 'HTTP/1.1'
+
+		def log_message(self, *args):
+			pass
+
+		def do_GET(self):
+			match = re.match(r'bytes=(\d+)-(\d+)', self.headers.get('Range') or '')
+			if match:
+				start, end = int(match.group(1)), min(int(match.group(2)), len(data) - 1)
+				self.send_response(206)
+				self.send_header('Content-Range', 'bytes %d-%d/%d' % (start, end, len(data)))
+			else:
+				start, end = 0, len(data) - 1
+				self.send_response(200)
+			self.send_header('Content-Length', str(end + 1 - start))
+			self.end_headers()
+			# Python 2 sockets write str() of a memoryview, so the view is sent as bytes, a chunk at a time
+			for position in range(start, end + 1, CHUNK_SIZE):
+				self.wfile.write(view[position:min(position + CHUNK_SIZE, end + 1)].tobytes())
+
+	server = _Server(('127.0.0.1', 0), Handler)
+	thread = threading.Thread(target=server.serve_forever)
+	thread.daemon = True
+	thread.start()
+	return 'http://127.0.0.1:%d' % server.server_address[1]
+
+def chunked_download(url, output_file, chunk_size=1024):
+	""" Download a file writing every chunk of iter_content, as the first versions of download_request did
+
+		The MD5 is computed on the way, as download_ticket does.
+	"""
+	md5 = hashlib.md5()
+	r = http_utils.get(url, headers={'Accept': 'application/octet-stream'}, stream=True)
+	with open(output_file, 'wb') as f:
+		for chunk in r.iter_content(chunk_size=chunk_size):
+			if chunk:
+				f.write(chunk)
+				md5.update(chunk)
+	return md5.hexdigest()
+
+def timed(function, *args, **kwargs):
+	start = time.time()
+	function(*args, **kwargs)
+	return time.time() - start
+
+def main():
+	parser = argparse.ArgumentParser(description="Download throughput benchmark of icgconnect")
+	parser.add_argument('--size-mb', type=int, default=256)
+	parser.add_argument('--workers', type=int, default=1)
+	parser.add_argument('--block-sizes', default='65536,1048576,4194304,16777216')
+	parser.add_argument('--preallocate', action='store_true')
+	args = parser.parse_args()
+
+	size = args.size_mb * 1024 * 1024
+	download._api_download_url = serve(os.urandom(size))
+	url = download._api_download_url+"/downloads/bench"
+	directory = tempfile.mkdtemp()
+	output_file = os.path.join(directory, 'bench.bin')
+
+	def report(label, seconds):
+		print("%-32s %8.1f MB/s" % (label, size / seconds / 1024 / 1024))
+
+	try:
+		report("iter_content 1 KB chunks", timed(chunked_download, url, output_file))
+		report("iter_content 1 MB chunks", timed(chunked_download, url, output_file, 1024 * 1024))
+		for block_size in [int(block_size) for block_size in args.block_sizes.split(',')]:
+			os.remove(output_file)
+			seconds = timed(download.download_ticket, 'bench', output_file, workers=args.workers, segment_size=size,
+							block_size=block_size, preallocate=args.preallocate)
+			report("download_ticket %d KB blocks" % (block_size // 1024), seconds)
+	finally:
+		shutil.rmtree(directory)
+
+if __name__ == '__main__':
+	main()
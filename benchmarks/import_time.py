@@ -0,0 +1,62 @@
+"""
+Import time benchmark of the icgconnect package
+
+Measures the time of `import icgconnect` in fresh interpreters and checks that no heavy dependency
+is imported with it. Exits with status 1 on a regression.
+
+	python benchmarks/import_time.py [--runs 10] [--max-seconds 0.05]
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+
+HEAVY_MODULES = ['requests', 'pysam', 'jsonschema', 'pkg_resources', 'icgconnect.ega', 'icgconnect.icgc', 'icgconnect.collab']
+
+_SCRIPT = """
+import sys, time
+start = time.time()
+import icgconnect
+elapsed = time.time() - start
+print(elapsed)
+print(','.join(module for module in %r if module in sys.modules))
+""" % HEAVY_MODULES
+
+def measure(runs):
+	""" Import icgconnect in fresh interpreters
+
+		Args:
+			runs (int):	Number of interpreters to start
+
+		Returns:
+			tuple:	The best import time in seconds and the heavy modules imported
+	"""
+	root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+	env = dict(os.environ, PYTHONPATH=root+os.pathsep+os.environ.get('PYTHONPATH', ''))
+	timings = []
+	loaded = []
+	for _ in range(runs):
+		output = subprocess.check_output([sys.executable, '-c', _SCRIPT], env=env).decode('utf-8').split('\n')
+		timings.append(float(output[0]))
+		loaded = [module for module in output[1].split(',') if module]
+	return min(timings), loaded
+
+def main():
+	parser = argparse.ArgumentParser(description="Import time benchmark of icgconnect")
+	parser.add_argument('--runs', type=int, default=10)
+	parser.add_argument('--max-seconds', type=float, default=0.05)
+	args = parser.parse_args()
+
+	best, loaded = measure(args.runs)
+	print("import icgconnect: %.2f ms (best of %d)" % (best * 1000, args.runs))
+
+	if loaded:
+		print("Heavy modules imported with icgconnect: "+', '.join(loaded))
+		sys.exit(1)
+	if best > args.max_seconds:
+		print("Import time over %.2f ms" % (args.max_seconds * 1000))
+		sys.exit(1)
+
+if __name__ == '__main__':
+	main()
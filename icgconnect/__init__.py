@@ -2,11 +2,45 @@
 This is whatever help info.
 
 This is whatever description
+
+The subpackages are imported on first access, so that importing icgconnect is nearly free:
+icgconnect.ega only loads the EGA wrappers and their dependencies the first time it is used.
 """
 
-import icgconnect.collab
-import icgconnect.aws
-import icgconnect.ega
-import icgconnect.icgc
-import icgconnect.icgc.song
-import icgconnect.xml_audit
+import importlib
+import sys
+import types
+
+# Modules imported on first access of each attribute of the package
+_LAZY_SUBMODULES = {
+	'aws': ['icgconnect.aws'],
+	'collab': ['icgconnect.collab'],
+	'ega': ['icgconnect.ega'],
+	'icgc': ['icgconnect.icgc'],
+	'utils': ['icgconnect.utils'],
+	'xml_audit': ['icgconnect.xml_audit']
+}
+
+class _LazyModule(types.ModuleType):
+	""" The icgconnect package, importing its subpackages on first access
+	"""
+
+	def __getattr__(self, name):
+		if not name in _LAZY_SUBMODULES:
+			raise AttributeError("module 'icgconnect' has no attribute '"+name+"'")
+		for module in _LAZY_SUBMODULES[name]:
+			importlib.import_module(module)
+		return sys.modules['icgconnect.'+name]
+
+	def __dir__(self):
+		return sorted(set(self.__dict__) | set(_LAZY_SUBMODULES))
+
+try:
+	sys.modules[__name__].__class__ = _LazyModule
+except TypeError:
+	# Python 2 cannot change the class of a module, the package module is replaced instead.
+	# The original module is kept referenced, its globals would be cleared otherwise.
+	_module = _LazyModule(__name__)
+	_module.__dict__.update(sys.modules[__name__].__dict__)
+	_module._original_module = sys.modules[__name__]
+	sys.modules[__name__] = _module
@@ -9,9 +9,10 @@ to communicate with aws especially for downloading or for uploading files.
 
 
 import subprocess
+from icgconnect.utils import progress_utils
 
 
-def download(object_id, icgc_storage_client, output_dir,force=True):
+def download(object_id, icgc_storage_client, output_dir,force=True, progress=None):
     """
     Download an ICGC file stored in aws using the object id. Make sure that you have the 
     icgc-storage-client (http://docs.icgc.org/cloud/guide/) installed on your computer before using this function.
@@ -23,8 +24,12 @@ def download(object_id, icgc_storage_client, output_dir,force=True):
     :param icgc_storage_client: The path of the icgc-storage client on your computer
     :param output_dir:          The output directory where the file will be downloaded
     :param force:               True overwrites an existing output file with the same name
+    :param progress:            A listener receiving progress events measured on the output directory, see utils.progress_utils
     """
+    args = [icgc_storage_client, '--profile','aws','download','--object-id',object_id,'--index=false','--output-dir',output_dir]
     if force:
-        subprocess.call([icgc_storage_client, '--profile','aws','download','--object-id',object_id,'--index=false','--output-dir',output_dir,'--force'])
-    else:
-        subprocess.call([icgc_storage_client, '--profile','aws','download','--object-id',object_id,'--index=false','--output-dir',output_dir])
\ No newline at end of file
+        args.append('--force')
+
+    if progress is None:
+        return subprocess.call(args)
+    return progress_utils.watch(subprocess.Popen(args), output_dir, object_id, progress)
\ No newline at end of file
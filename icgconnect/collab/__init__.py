@@ -1,12 +1,12 @@
 
-import requests
 import json
 import subprocess
 import os
 import csv
 import hashlib
 from icgconnect.utils import file_utils
-from pkg_resources import resource_string
+from icgconnect.utils import http_utils
+from icgconnect.utils import progress_utils
 
 _COLLAB_URL = "https://meta.icgc.org"
 
@@ -22,7 +22,7 @@ def entities_get(gnos_id):
         Raises:
             ValueError: Id does not exists in the records
     """
-    response = requests.get(_COLLAB_URL+'/entities?gnosId='+gnos_id).json().get('content')
+    response = http_utils.get(_COLLAB_URL+'/entities?gnosId='+gnos_id).json().get('content')
     if len(response) == 0:
         raise ValueError("GNOS id does not exist in the records: "+gnos_id)
     return response
@@ -50,7 +50,7 @@ def entities_post(id_service_token, gnos_id, filename, project_code):
     #    pass
     headers = {'Content-Type': 'application/json','Authorization': 'Bearer ' + id_service_token}
     body = {"gnosId": gnos_id,"fileName": filename,"projectCode": project_code,"access": "controlled"}
-    r = requests.post(_COLLAB_URL+'/entities', data=json.dumps(body), headers=headers)
+    r = http_utils.post(_COLLAB_URL+'/entities', data=json.dumps(body), headers=headers)
     print(r.text)
 
     if r.status_code == 401:
@@ -86,7 +86,7 @@ def entities_exists(gnos_id):
         Args:
             gnos_id (str):  An existing entity's id from GNOS
     """
-    return len(requests.get(_COLLAB_URL+'/entities?gnosId='+gnos_id).json().get('content')) > 0
+    return len(http_utils.get(_COLLAB_URL+'/entities?gnosId='+gnos_id).json().get('content')) > 0
 
 def filename_exists(gnos_id, filename):
     try:
@@ -151,7 +151,7 @@ def filename_post(gnos_id, id_service_token, filename, project_code):
 
     headers = {'Content-Type': 'application/json','Authorization': 'Bearer ' + id_service_token}
     body = {"gnosId": gnos_id,"fileName": filename,"projectCode": project_code,"access": "controlled"}
-    r = requests.post(_COLLAB_URL+'/entities', data=json.dumps(body), headers=headers)
+    r = http_utils.post(_COLLAB_URL+'/entities', data=json.dumps(body), headers=headers)
 
     if r.status_code == 401:
         raise ValueError("ICGC server error response: "+json.loads(r.text).get('error'))
@@ -342,7 +342,7 @@ def quick_upload(gnos_id, files, icgc_storage_client, force=True):
     upload(manifest_file, icgc_storage_client, force)
     delete_manifest_file(manifest_file, True)
 
-def download(object_id, icgc_storage_client, output_dir,force=True, skip_validation=False):
+def download(object_id, icgc_storage_client, output_dir,force=True, skip_validation=False, progress=None):
     args = []
 
     if skip_validation:
@@ -351,5 +351,8 @@ def download(object_id, icgc_storage_client, output_dir,force=True, skip_validat
     if force:
         args.append("--force")
 
-    subprocess.call([icgc_storage_client, '--profile', 'collab', 'download', '--object-id', object_id, '--index=false',
-                     '--output-dir', output_dir]+args)
\ No newline at end of file
+    command = [icgc_storage_client, '--profile', 'collab', 'download', '--object-id', object_id, '--index=false',
+               '--output-dir', output_dir]+args
+    if progress is None:
+        return subprocess.call(command)
+    return progress_utils.watch(subprocess.Popen(command), output_dir, object_id, progress)
\ No newline at end of file
@@ -1,2 +1,7 @@
 from .download import *
-from .submission import *
\ No newline at end of file
+from .submission import *
+from .session import *
+from .decryption import *
+from .catalog import *
+from .planner import *
+from .validation import *
\ No newline at end of file
@@ -0,0 +1,252 @@
+"""
+Local catalog of the EGA datasets and files
+
+The catalog keeps the files of the datasets listed by the EGA download API in a SQLite database,
+indexed by EGAD and EGAF ids, so that the metadata of the files is looked up without a request per
+file. Refreshing the catalog lists the files of each dataset once and records the files whose size,
+MD5 or status changed since the previous refresh.
+
+	catalog = Catalog('ega_catalog.db')
+	catalog.refresh(session_token)
+	catalog.file('EGAF00001000001')
+	catalog.changed_files(expected_files)
+"""
+
+import sqlite3
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+from icgconnect.ega import download
+from icgconnect.ega.session import call
+
+__all__ = ['Catalog']
+
+CATALOG_WORKERS = 4 # datasets listed concurrently by a refresh
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS datasets (
+	dataset_id TEXT PRIMARY KEY,
+	refreshed REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS files (
+	file_id TEXT NOT NULL,
+	dataset_id TEXT NOT NULL,
+	file_name TEXT,
+	file_index TEXT,
+	file_size INTEGER,
+	file_md5 TEXT,
+	file_status TEXT,
+	removed INTEGER NOT NULL DEFAULT 0,
+	refreshed REAL NOT NULL,
+	changed REAL NOT NULL,
+	PRIMARY KEY (dataset_id, file_id)
+);
+CREATE INDEX IF NOT EXISTS files_file ON files (file_id);
+CREATE INDEX IF NOT EXISTS files_changed ON files (changed);
+"""
+
+_SCHEMA_VERSION = 1
+
+# Catalogs created before the version 1 keyed the files by file_id only, moving a file of several datasets
+_MIGRATION = """
+DROP INDEX IF EXISTS files_dataset;
+DROP INDEX IF EXISTS files_changed;
+ALTER TABLE files RENAME TO files_v0;
+"""
+
+_FILE_COLUMNS = 'file_id, dataset_id, file_name, file_index, file_size, file_md5, file_status, removed, refreshed, changed'
+
+class Catalog(object):
+	""" A catalog of EGA datasets and files stored in a SQLite database
+
+		The catalog can be shared by threads, its queries are serialized.
+
+		Args:
+			path (str):	Path of the database, created if it does not exist. ':memory:' keeps the catalog in memory
+	"""
+
+	def __init__(self, path):
+		self.path = path
+		self._connection = sqlite3.connect(path, check_same_thread=False)
+		self._connection.row_factory = sqlite3.Row
+		self._lock = threading.Lock()
+		with self._lock, self._connection:
+			version = self._connection.execute("PRAGMA user_version").fetchone()[0]
+			migrate = version < _SCHEMA_VERSION and self._connection.execute(
+				"SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'files'").fetchone() is not None
+			if migrate:
+				self._connection.executescript(_MIGRATION)
+			self._connection.executescript(_SCHEMA)
+			if migrate:
+				self._connection.executescript(
+					"INSERT INTO files ("+_FILE_COLUMNS+") SELECT "+_FILE_COLUMNS+" FROM files_v0; DROP TABLE files_v0;")
+			self._connection.execute("PRAGMA user_version = %d" % _SCHEMA_VERSION)
+
+	def close(self):
+		""" Close the database
+		"""
+		with self._lock:
+			self._connection.close()
+
+	def refresh(self, session, dataset_ids=None, max_age=None, workers=CATALOG_WORKERS):
+		""" List the files of datasets from EGA and update the catalog
+
+			Args:
+				session:			A session token or an ega.Session
+				dataset_ids (list):	EGADIDs to refresh, all the datasets of the user by default
+				max_age (float):	Datasets refreshed less than max_age seconds ago are not listed again, None to list all
+				workers (int):		Number of datasets listed concurrently
+
+			Returns:
+				list:	The EGAFIDs added or changed by the refresh
+		"""
+		if dataset_ids is None:
+			dataset_ids = call(session, download.datasets_index)
+		dataset_ids = list(dataset_ids)
+		if max_age is not None:
+			fresh = set(row['dataset_id'] for row in self._query(
+				"SELECT dataset_id FROM datasets WHERE refreshed >= ?", (time.time() - max_age,)))
+			dataset_ids = [dataset_id for dataset_id in dataset_ids if not dataset_id in fresh]
+		if not dataset_ids:
+			return []
+
+		pool = ThreadPool(max(1, min(workers, len(dataset_ids))))
+		try:
+			changed = []
+			for dataset_id, files in pool.imap_unordered(lambda dataset_id: (dataset_id, call(session, download.files_index, dataset_id)), dataset_ids):
+				changed.extend(self.update(dataset_id, files))
+			return changed
+		finally:
+			pool.close()
+			pool.join()
+
+	def update(self, dataset_id, files):
+		""" Replace the files of a dataset with a listing from files_index
+
+			Files missing from the listing are marked as removed.
+
+			Args:
+				dataset_id (str):	An EGADID
+				files (list):		The files of the dataset returned by files_index
+
+			Returns:
+				list:	The EGAFIDs added or changed
+		"""
+		now = time.time()
+		changed = []
+		with self._lock, self._connection:
+			known = dict((row['file_id'], row) for row in self._connection.execute(
+				"SELECT "+_FILE_COLUMNS+" FROM files WHERE dataset_id = ?", (dataset_id,)))
+			rows = []
+			for _file in files:
+				row = (_file.get('fileID'), dataset_id, _file.get('fileName'), _file.get('fileIndex'),
+					   _size(_file.get('fileSize')), _file.get('fileMD5'), _file.get('fileStatus'))
+				previous = known.pop(row[0], None)
+				if previous is None or previous['removed'] or \
+						(previous['file_size'], previous['file_md5'], previous['file_status']) != row[4:7]:
+					changed.append(row[0])
+					rows.append(row + (now, now))
+				else:
+					rows.append(row + (now, previous['changed']))
+			self._connection.executemany(
+				"INSERT OR REPLACE INTO files ("+_FILE_COLUMNS+") VALUES (?, ?, ?, ?, ?, ?, ?, 0, ?, ?)", rows)
+			removed = [file_id for file_id, row in known.items() if not row['removed']]
+			self._connection.executemany(
+				"UPDATE files SET removed = 1, refreshed = ?, changed = ? WHERE dataset_id = ? AND file_id = ?",
+				[(now, now, dataset_id, file_id) for file_id in removed])
+			self._connection.execute("INSERT OR REPLACE INTO datasets (dataset_id, refreshed) VALUES (?, ?)", (dataset_id, now))
+		return changed + removed
+
+	def datasets(self):
+		""" The EGADIDs in the catalog
+
+			Returns:
+				list:	The dataset ids
+		"""
+		return [row['dataset_id'] for row in self._query("SELECT dataset_id FROM datasets ORDER BY dataset_id")]
+
+	def files(self, dataset_id):
+		""" The files of a dataset, as returned by files_index
+
+			Args:
+				dataset_id (str):	An EGADID
+
+			Returns:
+				list:	The files of the dataset, without the removed files
+		"""
+		return [_file_dict(row) for row in self._query(
+			"SELECT "+_FILE_COLUMNS+" FROM files WHERE dataset_id = ? AND removed = 0 ORDER BY file_id", (dataset_id,))]
+
+	def file(self, file_id):
+		""" The metadata of a file, as returned by files_get
+
+			A file of several datasets is returned with the first of its datasets.
+
+			Args:
+				file_id (str):	An EGAFID
+
+			Returns:
+				dict:	The file, None if it is not in the catalog or removed from all its datasets
+		"""
+		rows = self._query("SELECT "+_FILE_COLUMNS+" FROM files WHERE file_id = ? AND removed = 0 ORDER BY dataset_id LIMIT 1", (file_id,))
+		return _file_dict(rows[0]) if rows else None
+
+	def changed_since(self, timestamp):
+		""" The files added, changed or removed by the refreshes since a time
+
+			Args:
+				timestamp (float):	A time in seconds since the epoch
+
+			Returns:
+				list:	The files, with a removed key set to True for the files removed from their dataset
+		"""
+		return [_file_dict(row) for row in self._query(
+			"SELECT "+_FILE_COLUMNS+" FROM files WHERE changed >= ? ORDER BY file_id, dataset_id", (timestamp,))]
+
+	def changed_files(self, expected_files):
+		""" Compare files with the catalog
+
+			Args:
+				expected_files (list):	Files with the fileID, fileSize and fileMD5 keys, e.g. a listing saved earlier
+
+			Returns:
+				list:	The EGAFIDs missing from the catalog, or whose size or MD5 differ in all their datasets
+		"""
+		with self._lock:
+			cursor = self._connection.cursor()
+			try:
+				cursor.execute("CREATE TEMP TABLE IF NOT EXISTS expected (file_id TEXT PRIMARY KEY, file_size INTEGER, file_md5 TEXT)")
+				cursor.execute("DELETE FROM expected")
+				cursor.executemany("INSERT OR REPLACE INTO expected VALUES (?, ?, ?)",
+								   ((_file.get('fileID'), _size(_file.get('fileSize')), _file.get('fileMD5')) for _file in expected_files))
+				cursor.execute("SELECT expected.file_id FROM expected WHERE NOT EXISTS (SELECT 1 FROM files "
+							   "WHERE files.file_id = expected.file_id AND files.removed = 0 "
+							   "AND files.file_size IS expected.file_size AND lower(files.file_md5) IS lower(expected.file_md5)) "
+							   "ORDER BY expected.file_id")
+				changed = [row[0] for row in cursor.fetchall()]
+				cursor.execute("DELETE FROM expected")
+				self._connection.commit()
+				return changed
+			finally:
+				cursor.close()
+
+	def _query(self, sql, parameters=()):
+		with self._lock:
+			return self._connection.execute(sql, parameters).fetchall()
+
+def _size(size):
+	return int(size) if size not in (None, '') else None
+
+def _file_dict(row):
+	_file = {
+		'fileID': row['file_id'],
+		'fileDataset': row['dataset_id'],
+		'fileName': row['file_name'],
+		'fileIndex': row['file_index'],
+		'fileSize': row['file_size'],
+		'fileMD5': row['file_md5'],
+		'fileStatus': row['file_status']
+	}
+	if row['removed']:
+		_file['removed'] = True
+	return _file
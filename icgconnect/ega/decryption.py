@@ -0,0 +1,145 @@
+"""
+Decryption of the files downloaded from EGA
+
+Files are encrypted by the EGA download API with the key given when the request is created, the same
+way as EgaDemoClient does: AES-256 in CTR mode, the key derived from the encryption key with
+PBKDF2-HMAC-SHA1, and a random 16 bytes IV written before the encrypted bytes.
+
+CTR mode allows any range of a file to be decrypted independently, so that the ranges of a download
+are decrypted as they arrive. Requires the cryptography package (pip install icgconnect[crypto]).
+"""
+
+import binascii
+import hashlib
+import os
+from multiprocessing.pool import ThreadPool
+
+__all__ = ['decrypt_file', 'decrypt_files']
+
+HEADER_SIZE = 16 # size of the IV written before the encrypted bytes
+ENCRYPTED_SUFFIX = '.cip' # extension of the encrypted files
+KEY_SALT = b'\xf4\x22\x01\x00\x9e\xdf\x4e\x15' # salt of the key derivation of EgaDemoClient
+KEY_ITERATIONS = 1024
+KEY_SIZE = 32
+DECRYPTION_WORKERS = 4 # files decrypted concurrently by decrypt_files
+DECRYPTION_CHUNK_SIZE = 1024 * 1024 # bytes decrypted at a time
+
+class Decryptor(object):
+	""" Decryption of the bytes of an encrypted file, from any offset
+
+		Args:
+			key (bytes):	The AES key, derived from the encryption key with derive_key
+			iv (bytes):		The IV read from the header of the encrypted file
+	"""
+
+	def __init__(self, key, iv):
+		if len(iv) != HEADER_SIZE:
+			raise ValueError("The IV of an encrypted file must be "+str(HEADER_SIZE)+" bytes long, got "+str(len(iv)))
+		self.key = key
+		self._iv = int(binascii.hexlify(iv), 16)
+
+	def at(self, offset):
+		""" A stream decrypting the bytes following an offset
+
+			Args:
+				offset (int):	The offset of the next bytes in the decrypted file, i.e. after the header
+
+			Returns:
+				A decryption context, whose update method returns the decrypted bytes
+		"""
+		from cryptography.hazmat.backends import default_backend
+		from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+
+		counter = (self._iv + offset // 16) % (1 << 128)
+		cipher = Cipher(algorithms.AES(self.key), modes.CTR(binascii.unhexlify('%032x' % counter)), backend=default_backend())
+		context = cipher.decryptor()
+		context.update(b'\0' * (offset % 16))
+		return context
+
+def derive_key(decryption_key):
+	""" The AES key of an encryption key
+
+		Args:
+			decryption_key (str):	The encryption key given when the request was created
+
+		Returns:
+			bytes:	The AES key
+	"""
+	return hashlib.pbkdf2_hmac('sha1', decryption_key.encode('utf-8'), KEY_SALT, KEY_ITERATIONS, KEY_SIZE)
+
+def decrypted_file_name(encrypted_file):
+	""" The name of the decrypted file of an encrypted file, without the .cip extension
+
+		Args:
+			encrypted_file (str):	Path of the encrypted file
+
+		Returns:
+			str:	Path of the decrypted file
+	"""
+	if encrypted_file.endswith(ENCRYPTED_SUFFIX):
+		return encrypted_file[:-len(ENCRYPTED_SUFFIX)]
+	return encrypted_file+'.decrypted'
+
+def decrypt_file(encrypted_file, decryption_key, output_file=None):
+	""" Decrypt a file downloaded from EGA
+
+		Args:
+			encrypted_file (str):	Path of the encrypted file
+			decryption_key (str):	The encryption key given when the request was created
+			output_file (str):		Path of the decrypted file, the encrypted file without its .cip extension by default
+
+		Returns:
+			str:	Path of the decrypted file
+
+		Raises:
+			ValueError:	The file is too short to be encrypted
+	"""
+	return _decrypt_file(encrypted_file, derive_key(decryption_key), output_file or decrypted_file_name(encrypted_file))
+
+def decrypt_files(encrypted_files, decryption_key, workers=DECRYPTION_WORKERS):
+	""" Decrypt many files downloaded from EGA concurrently
+
+		Args:
+			encrypted_files (list):	Paths of the encrypted files, decrypted next to them without their .cip extension
+			decryption_key (str):	The encryption key given when the request was created
+			workers (int):			Number of files decrypted concurrently
+
+		Returns:
+			dict:	The decrypted files (list of paths) and the error of each file that could not be decrypted (dict by path)
+	"""
+	key = derive_key(decryption_key)
+	report = {'decrypted': [], 'failed': {}}
+	encrypted_files = list(encrypted_files)
+	if not encrypted_files:
+		return report
+
+	def _decrypt(encrypted_file):
+		try:
+			return encrypted_file, _decrypt_file(encrypted_file, key, decrypted_file_name(encrypted_file)), None
+		except Exception as err:
+			return encrypted_file, None, str(err)
+
+	pool = ThreadPool(max(1, min(workers, len(encrypted_files))))
+	try:
+		for encrypted_file, output_file, error in pool.imap_unordered(_decrypt, encrypted_files):
+			if error is None:
+				report['decrypted'].append(output_file)
+			else:
+				report['failed'][encrypted_file] = error
+	finally:
+		pool.close()
+		pool.join()
+	return report
+
+def _decrypt_file(encrypted_file, key, output_file):
+	with open(encrypted_file, 'rb') as f:
+		iv = f.read(HEADER_SIZE)
+		if len(iv) != HEADER_SIZE:
+			raise ValueError(encrypted_file+" is too short to be an encrypted file")
+		context = Decryptor(key, iv).at(0)
+		with open(output_file+'.part', 'wb') as out:
+			for chunk in iter(lambda: f.read(DECRYPTION_CHUNK_SIZE), b''):
+				out.write(context.update(chunk))
+			out.write(context.finalize())
+	os.rename(output_file+'.part', output_file)
+	return output_file
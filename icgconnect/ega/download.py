@@ -7,10 +7,19 @@ Have a look at the submission wrapper if you need functions for EGA submission A
 
 import requests
 import re
+import binascii
 import json
 import subprocess
 import hashlib
 import os
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+from icgconnect.utils import file_utils
+from icgconnect.utils import http_utils
+from icgconnect.utils import progress_utils
+from icgconnect.ega.session import EgaResponseError, Session, call
+from icgconnect.ega import decryption
 from requests.packages.urllib3.exceptions import InsecureRequestWarning
 
 requests.packages.urllib3.disable_warnings(InsecureRequestWarning)
@@ -18,6 +27,15 @@ requests.packages.urllib3.disable_warnings(InsecureRequestWarning)
 _api_access_url = "https://ega.ebi.ac.uk/ega/rest/access/v2"
 _api_download_url = "http://ega.ebi.ac.uk/ega/rest/ds/v2"
 
+DOWNLOAD_WORKERS = 4 # connections used to download one file
+DOWNLOAD_SEGMENT_SIZE = 16 * 1024 * 1024 # bytes requested per range request
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024 # bytes read from a file at a time to compute its MD5
+DOWNLOAD_BLOCK_SIZE = 4 * 1024 * 1024 # size of the buffer each connection reads into before writing to the file
+DIGEST_WINDOW_SIZE = 64 * 1024 * 1024 # bytes past the MD5 frontier kept in memory, further bytes are read back from the file
+JOURNAL_SUFFIX = '.journal' # sidecar file recording the ranges of an interrupted download
+DATASET_PARALLEL_FILES = 4 # files of a dataset downloaded concurrently
+BULK_WORKERS = 8 # requests or tickets created or deleted concurrently by the bulk functions
+
 def login(email, password):
 	"""
 	Log-in to the EGA download API
@@ -34,10 +52,21 @@ def login(email, password):
 		raise ValueError(email+" is not a valid email")
 
 	try:
-		return _result_from_response(requests.get(_api_access_endpoint("/users/"+email+"?pass="+password, None), verify=False))[1]
+		return _result_from_response(http_utils.get(_api_access_endpoint("/users/"+email+"?pass="+password, None), verify=False))[1]
 	except ValueError as err:
 		raise ValueError("EGA response: "+str(err)+" - Verify email and password")
 
+def create_session(email, password, token_file=None):
+	"""
+	Create a session of the EGA download API, logging in when the token is first used and again when it expires
+	
+	:param email: 		User's email address
+	:param password: 	User's password
+	:param token_file: 	A file caching the token for other processes, None to keep it in memory
+	:return Session: 	A session to pass to download_dataset or to call the functions of this module with
+	"""
+	return Session(login, email, password, token_file)
+
 def logout(session_token):
 	"""
 	Log-out the EGA download API
@@ -46,7 +75,7 @@ def logout(session_token):
 	:return boolean: 		True if logged out successfully, False otherwise
 	"""
 	_validate_session_token(session_token)
-	return 'logged out' in _result_from_response(requests.get(_api_access_endpoint("/users/logout",session_token), verify=False))[0]
+	return 'logged out' in _result_from_response(http_utils.get(_api_access_endpoint("/users/logout",session_token), verify=False))[0]
 
 def datasets_index(session_token):
 	"""
@@ -56,7 +85,7 @@ def datasets_index(session_token):
 	:return array: 		An array of EGADids submitted by the user
 	"""
 	_validate_session_token(session_token)
-	return _result_from_response(requests.get(_api_access_endpoint("/datasets",session_token), verify=False))
+	return _result_from_response(http_utils.get(_api_access_endpoint("/datasets",session_token), verify=False))
 
 def files_index(session_token, dataset):
 	"""
@@ -80,7 +109,7 @@ def files_index(session_token, dataset):
 	:return array: 		A List of files in the dataset
 	"""
 	_validate_session_token(session_token)
-	return _result_from_response(requests.get(_api_access_endpoint("/datasets/"+dataset+"/files",session_token), verify=False))
+	return _result_from_response(http_utils.get(_api_access_endpoint("/datasets/"+dataset+"/files",session_token), verify=False))
 
 def files_get(session_token, file_id):
 	"""
@@ -93,9 +122,9 @@ def files_get(session_token, file_id):
 	:return dict: 		Info about the requested file
 	"""
 	_validate_session_token(session_token)
-	return _result_from_response(requests.get(_api_access_endpoint("/files/"+file_id,session_token), verify=False))[0]
+	return _result_from_response(http_utils.get(_api_access_endpoint("/files/"+file_id,session_token), verify=False))[0]
 
-def requests_index(session_token):
+def requests_index(session_token, label_prefix=None):
 	"""
 	Retrieve the list of requests from the authenticated user
 	
@@ -112,10 +141,23 @@ def requests_index(session_token):
 	- fileID: EGAFID
 	
 	:param session_token: 	A valid user session token
+	:param label_prefix: 	Only return the requests whose label starts with the prefix, None for all the requests
 	:return array: 			List of requests
 	"""
 	_validate_session_token(session_token)
-	return _result_from_response(requests.get(_api_access_endpoint("/requests",session_token), verify=False))
+	return requests_filter(_result_from_response(http_utils.get(_api_access_endpoint("/requests",session_token), verify=False)), label_prefix)
+
+def requests_filter(requests, label_prefix=None):
+	"""
+	Filter a list of requests already retrieved with requests_index by label prefix
+	
+	:param requests: 		Requests returned by requests_index
+	:param label_prefix: 	Prefix of the labels of the requests to keep, None to keep all the requests
+	:return array: 			List of requests
+	"""
+	if label_prefix is None:
+		return list(requests)
+	return [request for request in requests if (request.get('label') or '').startswith(label_prefix)]
 
 def requests_get(session_token, request_label):
 	"""
@@ -128,7 +170,7 @@ def requests_get(session_token, request_label):
 	:return dict: The request 
 	"""
 	_validate_session_token(session_token)
-	return _result_from_response(requests.get(_api_access_endpoint("/requests/"+request_label,session_token), verify=False))[0]
+	return _result_from_response(http_utils.get(_api_access_endpoint("/requests/"+request_label,session_token), verify=False))[0]
 
 def requests_delete(session_token, request_label):
 	"""
@@ -139,7 +181,7 @@ def requests_delete(session_token, request_label):
 	:return string: 'OK' if the request was deleted 
 	"""
 	_validate_session_token(session_token)
-	return _result_from_response(requests.get(_api_access_endpoint("/requests/delete/"+request_label, session_token), verify=False))[0]
+	return _result_from_response(http_utils.get(_api_access_endpoint("/requests/delete/"+request_label, session_token), verify=False))[0]
 
 def requests_create(session_token, object_id, type, encryption_key, request_label):
 	"""
@@ -160,11 +202,51 @@ def requests_create(session_token, object_id, type, encryption_key, request_labe
 	if not type.lower() in ['datasets','files']:
 		raise ValueError("Request can be created only on files or datasets")
 
-	downloadrequest = {'downloadrequest':'{"rekey":'+encryption_key+',"downloadType":"STREAM","descriptor":'+request_label+'}'}
-	requests.post("https://ega.ebi.ac.uk/ega/rest/access/v2/requests/new/"+type+"/"+object_id+"?session="+session_token,data=downloadrequest,headers={'Accept':'application/json'}, verify=False)
-
+	_requests_post(session_token, object_id, type, encryption_key, request_label)
 	return requests_get(session_token,request_label)
 
+def requests_create_many(session_token, file_ids, encryption_key, label_prefix, workers=BULK_WORKERS):
+	"""
+	Create a request for each of many files concurrently
+	
+	The request of a file is labelled with the prefix followed by the EGAFID. The requests are read back
+	with a single requests_index instead of one requests_get per request.
+	
+	Return a dictionary with keys:
+	- created: The created requests by EGAFID
+	- failed: Error message of each file whose request could not be created, by EGAFID
+	
+	:param session_token: 	A valid user session token or a Session
+	:param file_ids: 		EGAFIDs to request
+	:param encryption_key: 	An encryption key
+	:param label_prefix: 	Prefix of the labels of the requests
+	:param workers: 		Number of requests created concurrently
+	:return dict: 			A report of the creation
+	"""
+	file_ids = list(file_ids)
+	report = _call_many(session_token, lambda token, file_id: _requests_post(token, file_id, 'files', encryption_key, label_prefix+file_id), file_ids, workers)
+	labels = dict((label_prefix+file_id, file_id) for file_id in report['done'])
+	created = dict((labels[request.get('label')], request) for request in call(session_token, requests_index, label_prefix) if request.get('label') in labels)
+	for file_id in labels.values():
+		if not file_id in created:
+			report['failed'][file_id] = "Request not listed by EGA after its creation"
+	return {'created': created, 'failed': report['failed']}
+
+def requests_delete_many(session_token, request_labels, workers=BULK_WORKERS):
+	"""
+	Delete many requests concurrently
+	
+	Return a dictionary with keys:
+	- deleted: The labels of the deleted requests
+	- failed: Error message of each request that could not be deleted, by label
+	
+	:param session_token: 	A valid user session token or a Session
+	:param request_labels: 	The labels of the requests, e.g. of requests_index(session_token, label_prefix)
+	:param workers: 		Number of requests deleted concurrently
+	:return dict: 			A report of the deletion
+	"""
+	return _call_many(session_token, requests_delete, request_labels, workers, 'deleted')
+
 def tickets_get(session_token, ticket_id):
 	""" Informations about a ticket
 
@@ -176,7 +258,7 @@ def tickets_get(session_token, ticket_id):
 			dict: The informations about the existing ticket
 	"""
 	_validate_session_token(session_token)
-	return _result_from_response(requests.get(_api_access_endpoint("/requests/ticket/"+ticket_id,session_token), verify=False))
+	return _result_from_response(http_utils.get(_api_access_endpoint("/requests/ticket/"+ticket_id,session_token), verify=False))
 
 def tickets_delete(session_token, ticket_id):
 	""" Delete an existing ticket
@@ -189,7 +271,20 @@ def tickets_delete(session_token, ticket_id):
 			dict: The EGA response after deletion
 	"""
 	_validate_session_token(session_token)
-	return _result_from_response(requests.get(_api_access_endpoint("/requests/ticket/delete/"+ticket_id,session_token), verify=False))
+	return _result_from_response(http_utils.get(_api_access_endpoint("/requests/ticket/delete/"+ticket_id,session_token), verify=False))
+
+def tickets_delete_many(session_token, ticket_ids, workers=BULK_WORKERS):
+	""" Delete many tickets concurrently
+
+		Args:
+			session_token: A valid session token or a Session
+			ticket_ids: The ids of existing tickets
+			workers: Number of tickets deleted concurrently
+
+		Return:
+			dict: The deleted tickets (list of ids) and the error of each ticket that could not be deleted (dict by id)
+	"""
+	return _call_many(session_token, tickets_delete, ticket_ids, workers, 'deleted')
 
 def _api_access_endpoint(endpoint,session_token=None):
 	""" Create the endpoint to call
@@ -205,6 +300,74 @@ def _api_access_endpoint(endpoint,session_token=None):
 		return _api_access_url+endpoint
 	return _api_access_url+endpoint+"?session="+session_token
 
+def _requests_post(session_token, object_id, type, encryption_key, request_label):
+	""" Create a new file or dataset request without reading it back
+
+		Args:
+			session_token:	A valid session token
+			object_id:		EGAFID or EGADID to download
+			type:			files or datasets
+			encryption_key:	An encryption key
+			request_label:	A label for the request
+
+		Raises:
+			EgaResponseError: An error from the server, e.g. an expired session
+	"""
+	_validate_session_token(session_token)
+	downloadrequest = {'downloadrequest':'{"rekey":'+encryption_key+',"downloadType":"STREAM","descriptor":'+request_label+'}'}
+	_result_from_response(http_utils.post(_api_access_url+"/requests/new/"+type+"/"+object_id+"?session="+session_token,data=downloadrequest,headers={'Accept':'application/json'}, verify=False))
+
+def _is_downloaded(output_file, size, md5=None):
+	""" Check if a file is already downloaded with the expected size and MD5
+
+		Args:
+			output_file:	The path of the downloaded file
+			size:			The expected size of the file
+			md5:			The expected MD5 of the file, None to check the size only
+	"""
+	if not os.path.isfile(output_file) or os.path.isfile(output_file+JOURNAL_SUFFIX):
+		return False
+	if size is None or os.path.getsize(output_file) != int(size):
+		return False
+	return md5 is None or file_utils.get_file_md5(output_file) == md5.lower()
+
+def _call_many(session, function, items, workers, done_key='done'):
+	""" Call an API function for many items concurrently
+
+		Args:
+			session:	A session token or a Session
+			function:	A function taking the session token and an item
+			items:		The items
+			workers:	Number of concurrent calls
+			done_key:	The key of the successful items in the report
+
+		Returns:
+			dict:	The successful items (list) and the error of each failed item (dict by item)
+	"""
+	items = list(items)
+	report = {done_key: [], 'failed': {}}
+	if not items:
+		return report
+
+	def _call_item(item):
+		try:
+			call(session, function, item)
+			return item, None
+		except Exception as err:
+			return item, str(err)
+
+	pool = ThreadPool(max(1, min(workers, len(items))))
+	try:
+		for item, error in pool.imap_unordered(_call_item, items):
+			if error is None:
+				report[done_key].append(item)
+			else:
+				report['failed'][item] = error
+	finally:
+		pool.close()
+		pool.join()
+	return report
+
 def _validate_session_token(session_token):
 	""" Check if the session token is valid
 
@@ -224,10 +387,10 @@ def _validate_response(json_response):
 			json_response:	A json response from server request result
 
 		Raises:
-			ValueError: An error from the server
+			EgaResponseError: An error from the server
 	"""
 	if json_response['header']['code'] != "200":
-		raise ValueError(json_response['header']['userMessage'])
+		raise EgaResponseError(json_response['header']['userMessage'], json_response['header']['code'])
 
 def _result_from_response(raw_response):
 	""" Retrieve the result from server response
@@ -239,29 +402,180 @@ def _result_from_response(raw_response):
 	_validate_response(r)
 	return r['response']['result']
 
-def download_request(session_token, request_label, type,output_file):
+def download_dataset(session_token, dataset_id, out_dir, encryption_key, max_parallel_files=DATASET_PARALLEL_FILES,
+					 bandwidth_limit=None, workers=DOWNLOAD_WORKERS, request_label=None, decrypt=False, progress=None):
+	"""
+	Download all the files of a dataset
+	
+	A single request is created for the whole dataset, and deleted once its files are downloaded. The files
+	are downloaded concurrently, the largest first so that a big file does not start last. Files already in
+	the output directory with the expected size and MD5 are skipped, and interrupted downloads are resumed.
+	A file failing to download does not stop the others, it is reported in the result.
+	
+	The files are named after the base name of their fileName. Files of the dataset sharing a base name
+	are prefixed with their EGAFID.
+	
+	With decrypt, the files are decrypted with the encryption key while they are downloaded and only the
+	decrypted files are written, without their .cip extension.
+	
+	The fileMD5 listed by EGA is the MD5 of the decrypted file, so it is only verified with decrypt. The
+	encrypted files are checked by size only: the listed fileSize plus the 16 bytes IV of their header.
+	
+	Return a dictionary with keys:
+	- downloaded: EGAFIDs of the downloaded files
+	- skipped: EGAFIDs of the files already present
+	- failed: Error message of each file that could not be downloaded, by EGAFID
+	- bytes: Number of bytes downloaded
+	- seconds: Duration of the download
+	- throughput: Average throughput in bytes per second
+	
+	:param session_token: 		A valid user session token or a Session
+	:param dataset_id: 			An EGADID
+	:param out_dir: 			The directory where the files are downloaded
+	:param encryption_key: 		An encryption key
+	:param max_parallel_files: 	Number of files downloaded concurrently
+	:param bandwidth_limit: 	Maximum throughput in bytes per second of the whole dataset download, None for no limit
+	:param workers: 			Number of connections used for each file
+	:param request_label: 		A label for the request, generated from the dataset id by default
+	:param decrypt: 			True to decrypt the files while they are downloaded
+	:param progress: 			A listener receiving the progress events of each file, see utils.progress_utils
+	:return dict: 				A report of the download
+	"""
+	start_time = time.time()
+	report = {'downloaded': [], 'skipped': [], 'failed': {}}
+	files = []
+	dataset_files = call(session_token, files_index, dataset_id)
+	names = [os.path.basename(_file.get('fileName')) for _file in dataset_files]
+	for _file, name in zip(dataset_files, names):
+		if names.count(name) > 1:
+			name = _file.get('fileID')+'_'+name
+		output_file = os.path.join(out_dir, name)
+		if decrypt:
+			output_file = decryption.decrypted_file_name(output_file)
+			downloaded = _is_downloaded(output_file, _file.get('fileSize'), _file.get('fileMD5'))
+		else:
+			downloaded = _file.get('fileSize') not in (None, '') and _is_downloaded(output_file, int(_file['fileSize']) + decryption.HEADER_SIZE)
+		if downloaded:
+			report['skipped'].append(_file.get('fileID'))
+		else:
+			files.append((_file, output_file))
+
+	throttle = _Throttle(bandwidth_limit)
+	if files:
+		request_label = request_label or dataset_id+'_'+str(int(time.time()))
+		call(session_token, _requests_post, dataset_id, 'datasets', encryption_key, request_label)
+
+		def _download_file(item):
+			_file, output_file = item
+			try:
+				if tickets.get(_file.get('fileID')) is None:
+					raise ValueError("No ticket created for the file")
+				download_ticket(tickets[_file.get('fileID')], output_file, workers, md5=_file.get('fileMD5') if decrypt else None, throttle=throttle,
+								decryption_key=encryption_key if decrypt else None, progress=progress)
+				return _file.get('fileID'), None
+			except Exception as err:
+				return _file.get('fileID'), str(err)
+
+		files.sort(key=lambda item: int(item[0].get('fileSize') or 0), reverse=True)
+		pool = ThreadPool(max(1, min(max_parallel_files, len(files))))
+		try:
+			tickets = dict((request.get('fileID'), request.get('ticket')) for request in call(session_token, requests_index) if request.get('label') == request_label)
+			for file_id, error in pool.imap_unordered(_download_file, files):
+				if error is None:
+					report['downloaded'].append(file_id)
+				else:
+					report['failed'][file_id] = error
+		finally:
+			pool.close()
+			pool.join()
+			requests_delete_many(session_token, [request_label])
+
+	report['bytes'] = throttle.transferred
+	report['seconds'] = time.time() - start_time
+	report['throughput'] = report['bytes'] / report['seconds'] if report['seconds'] > 0 else 0
+	return report
+
+def download_request(session_token, request_label, type, output_file, workers=DOWNLOAD_WORKERS, segment_size=DOWNLOAD_SEGMENT_SIZE, md5=None, verify_md5=True,
+					 decryption_key=None, progress=None, block_size=DOWNLOAD_BLOCK_SIZE, preallocate=False):
 	"""
 	Download a request successfully previously created by the connected user
 	
+	The MD5 of the file is computed while it is downloaded. With a decryption key, it is compared with the
+	fileMD5 of the requested file, the MD5 of the decrypted file. The encrypted file is not verified by default.
+	
+	ValueError: If the MD5 of the downloaded file does not match
+	
 	:param session_token: 	A valid user session token
 	:param request_label: 	The request's label to download
-	:param type: 			
+	:param type: 			files or datasets
 	:param output_file: 	The path of the output file
+	:param workers: 		Number of connections downloading byte ranges of the file concurrently
+	:param segment_size: 	Size in bytes of the ranges
+	:param md5: 			The expected MD5 of the written file, retrieved with files_get by default when decrypting
+	:param verify_md5: 		False to skip the MD5 verification
+	:param decryption_key: 	The encryption key of the request to write the decrypted file, None to write the encrypted file
+	:param progress: 		A listener receiving the progress events of the download, see utils.progress_utils
+	:param block_size: 		Size in bytes of the buffer of each connection
+	:param preallocate: 	True to allocate the disk blocks of the output file before downloading it
+	:return string: 		The MD5 of the downloaded file
 	"""
 	if not type.lower() in ['datasets','files']:
 		raise ValueError("Request can be created only on files or datasets")
 
 	if type == "files":
-		ticket_id = requests_get(session_token, request_label)[0].get('ticket')
-		r = requests.get(_api_download_url+"/downloads/"+ticket_id,headers={'Accept': 'application/octet-stream'}, stream=True)
-		with open(output_file,"wb") as f:
-			for chunk in r.iter_content(chunk_size=1024):
-				if chunk:
-					f.write(chunk)
+		request = requests_get(session_token, request_label)[0]
+		if md5 is None and verify_md5 and decryption_key:
+			md5 = files_get(session_token, request.get('fileID')).get('fileMD5')
+		return download_ticket(request.get('ticket'), output_file, workers, segment_size, md5 if verify_md5 else None, decryption_key=decryption_key, progress=progress,
+							   block_size=block_size, preallocate=preallocate)
+
+def download_ticket(ticket_id, output_file, workers=DOWNLOAD_WORKERS, segment_size=DOWNLOAD_SEGMENT_SIZE, md5=None, throttle=None, decryption_key=None, progress=None,
+					block_size=DOWNLOAD_BLOCK_SIZE, preallocate=False):
+	"""
+	Download the file of a ticket
+	
+	The file is split into byte ranges downloaded concurrently over several connections, each range
+	being written at its offset in the preallocated output file. The file is downloaded over a single
+	connection if the server does not support range requests.
+	
+	The completed ranges are recorded in a journal next to the output file (output_file.journal).
+	If the download is interrupted, calling this function again only downloads the missing ranges,
+	unless the size of the remote file or its expected MD5 changed since.
+	
+	Each connection reads the response into a reusable buffer of block_size bytes, directly from the socket
+	when possible, and writes it to the file at once. With preallocate, the disk blocks of the output file are
+	allocated before the download (os.posix_fallocate) so that the file is not fragmented.
+	
+	The MD5 is computed while the bytes arrive, the ranges being hashed in order as soon as the ranges
+	before them are complete. Only the ranges downloaded before an interruption are read again from disk.
+	
+	With a decryption key, each range is decrypted as it arrives and only the decrypted file is written,
+	instead of decrypting the encrypted file once downloaded. The MD5 is then the MD5 of the decrypted file.
+	Without a decryption key, the MD5 is the MD5 of the encrypted file, which differs from the fileMD5 of EGA.
+	
+	ValueError: If a range is not fully downloaded
+	ValueError: If the MD5 of the downloaded file does not match the expected MD5
+	
+	:param ticket_id: 		A ticket of a request
+	:param output_file: 	The path of the output file
+	:param workers: 		Number of connections downloading byte ranges of the file concurrently
+	:param segment_size: 	Size in bytes of the ranges
+	:param md5: 			The expected MD5 of the file, not verified if None
+	:param throttle: 		A throttle shared by several downloads to limit their total throughput
+	:param decryption_key: 	The encryption key of the request to write the decrypted file, None to write the encrypted file
+	:param progress: 		A listener receiving the progress events of the download, e.g. progress_utils.JsonLinesExporter
+	:param block_size: 		Size in bytes of the buffer of each connection
+	:param preallocate: 	True to allocate the disk blocks of the output file before downloading it
+	:return string: 		The MD5 of the downloaded file
+	"""
+	return _Download(_api_download_url+"/downloads/"+ticket_id, output_file, workers, segment_size, md5, throttle, decryption_key, progress,
+					 block_size, preallocate).run()
 
 def decrypt_encrypted_file(email,password,_file,decryption_key):
 	"""
-	Decrypt an ecrypted file from EGA
+	Decrypt an ecrypted file from EGA with EgaDemoClient
+	
+	decryption.decrypt_file decrypts in process without Java, and download_ticket can decrypt while downloading.
 	
 	:param email: 			User's login e-mail
 	:param password: 		User's login password
@@ -274,4 +588,319 @@ def decrypt_encrypted_file(email,password,_file,decryption_key):
 
 	subprocess.call(['java','-jar','EgaDemoClient.jar','-p',email,password,'-dc',_file,'-dck',decryption_key])
 
+class _Download(object):
+	""" Download of a file over HTTP, by byte ranges fetched concurrently
+
+		Args:
+			url (str):			The URL of the file
+			output_file (str):	The path of the output file
+			workers (int):		Number of concurrent range requests
+			segment_size (int):	Size in bytes of the ranges
+			md5 (str):			The expected MD5 of the file
+			throttle (_Throttle):	A throttle limiting the throughput
+			decryption_key (str):	The encryption key of the remote file to write it decrypted, None to write it as is
+			progress:				A listener receiving the progress events of the download
+			block_size (int):		Size in bytes of the buffer of each connection
+			preallocate (bool):		True to allocate the disk blocks of the output file before downloading it
+	"""
+
+	def __init__(self, url, output_file, workers, segment_size, md5=None, throttle=None, decryption_key=None, progress=None,
+				 block_size=DOWNLOAD_BLOCK_SIZE, preallocate=False):
+		self.url = url
+		self.output_file = output_file
+		self.workers = max(1, workers)
+		self.segment_size = segment_size
+		self.md5 = md5
+		self.journal_file = output_file+JOURNAL_SUFFIX
+		self.digest = _OrderedDigest(output_file)
+		self.throttle = throttle or _Throttle(None)
+		self.key = decryption.derive_key(decryption_key) if decryption_key else None
+		self.header_size = decryption.HEADER_SIZE if self.key else 0
+		self.decryptor = None
+		self.remote_header = None
+		self.progress = progress_utils.Progress(output_file, progress)
+		self.block_size = block_size
+		self.preallocate = preallocate
+		self._buffers = threading.local()
+
+	def run(self):
+		try:
+			md5 = self._run()
+		except Exception as err:
+			self.progress.finish(str(err))
+			raise
+		self.progress.finish()
+		return md5
+
+	def _run(self):
+		size = self._remote_size()
+		self.progress.total = size
+		if size is None:
+			self._download_stream()
+		else:
+			self._download_segments(size)
+		if os.path.isfile(self.journal_file):
+			os.remove(self.journal_file)
+
+		md5 = self.digest.hexdigest()
+		if self.md5 and md5 != self.md5.lower():
+			raise ValueError("MD5 of the downloaded file "+self.output_file+" does not match. Expected: "+self.md5+", downloaded: "+md5)
+		return md5
+
+	def _remote_size(self):
+		""" The size of the output file, None if the server does not support range requests
+
+			The first bytes of the remote file are read at the same time: the IV of an encrypted file,
+			used to decrypt the ranges and to check that a resumed download continues the same file.
+		"""
+		r = http_utils.get(self.url, headers={'Accept': 'application/octet-stream', 'Range': 'bytes=0-%d' % (decryption.HEADER_SIZE - 1)}, stream=True)
+		try:
+			content_range = r.headers.get('Content-Range', '')
+			if r.status_code != 206 or not '/' in content_range or content_range.endswith('/*'):
+				return None
+			self.remote_header = r.content[:decryption.HEADER_SIZE]
+			if self.key:
+				self.decryptor = decryption.Decryptor(self.key, self.remote_header)
+			return int(content_range.split('/')[1]) - self.header_size
+		finally:
+			r.close()
+
+	def _download_stream(self):
+		r = http_utils.get(self.url, headers={'Accept': 'application/octet-stream'}, stream=True)
+		try:
+			readinto = _response_readinto(r)
+			context = None
+			if self.header_size:
+				header = memoryview(bytearray(self.header_size))
+				if _fill(readinto, header) != self.header_size:
+					raise ValueError("Encrypted file "+self.url+" is shorter than its header")
+				context = decryption.Decryptor(self.key, header.tobytes()).at(0)
+			with open(self.output_file, "wb") as f:
+				self._write_response(readinto, f, 0, context)
+			self.progress.retry(_retries(r))
+		finally:
+			_release(r)
+
+	def _download_segments(self, size):
+		journal = self._load_journal(size)
+		if journal is None:
+			with open(self.output_file, "wb") as f:
+				f.truncate(size)
+				if self.preallocate and size and hasattr(os, 'posix_fallocate'):
+					os.posix_fallocate(f.fileno(), 0, size)
+			journal = {'size': size, 'md5': self.md5, 'segment_size': self.segment_size, 'decrypted': self.key is not None,
+					   'url': self.url, 'header': binascii.hexlify(self.remote_header).decode('ascii'), 'completed': []}
+			file_utils.write_json(self.journal_file, journal)
+
+		completed = set(journal['completed'])
+		for start in completed:
+			self.digest.update_from_file(start, min(start+self.segment_size, size)-1)
+		segments = [(start, min(start+self.segment_size, size)-1) for start in range(0, size, self.segment_size) if not start in completed]
+		pool = ThreadPool(min(self.workers, len(segments)) or 1)
+		try:
+			for start in pool.imap_unordered(self._download_segment, segments):
+				journal['completed'].append(start)
+				file_utils.write_json(self.journal_file, journal)
+		finally:
+			pool.terminate()
+			pool.join()
+
+	def _write_response(self, readinto, f, offset, context=None):
+		""" Write the body of a response to the file, one buffer at a time
+
+			Returns:
+				int:	The offset following the last byte written
+		"""
+		buffer = getattr(self._buffers, 'buffer', None)
+		if buffer is None or len(buffer) != self.block_size:
+			buffer = self._buffers.buffer = memoryview(bytearray(self.block_size))
+		while True:
+			size = _fill(readinto, buffer)
+			if not size:
+				return offset
+			data = buffer[:size] if context is None else context.update(buffer[:size])
+			f.write(data)
+			f.flush()
+			self.digest.update(offset, data)
+			self.throttle.consume(size)
+			self.progress.add(size)
+			offset += size
+
+	def _load_journal(self, size):
+		""" The journal of an interrupted download of the same file, None if the download cannot be resumed
+
+			EGA encrypts each ticket with a random IV, so the encrypted bytes of a file downloaded with
+			another ticket differ. An encrypted download is only resumed if the remote file starts with
+			the same IV. A decrypted download does not depend on the IV and resumes with any ticket.
+		"""
+		if not os.path.isfile(self.journal_file) or not os.path.isfile(self.output_file):
+			return None
+		try:
+			with open(self.journal_file, 'r') as f:
+				journal = json.load(f)
+		except ValueError:
+			return None
+
+		if journal.get('size') != size or os.path.getsize(self.output_file) != size:
+			return None
+		if journal.get('segment_size') != self.segment_size or journal.get('decrypted', False) != (self.key is not None):
+			return None
+		if self.md5 and journal.get('md5') and journal['md5'] != self.md5:
+			return None
+		if self.key is None and journal.get('header') != binascii.hexlify(self.remote_header).decode('ascii'):
+			return None
+		return journal
+
+	def _download_segment(self, segment):
+		start, end = segment
+		start_time = time.time()
+		r = http_utils.get(self.url, headers={'Accept': 'application/octet-stream', 'Range': 'bytes=%d-%d' % (start + self.header_size, end + self.header_size)}, stream=True)
+		if r.status_code != 206:
+			r.close()
+			raise ValueError("EGA server did not return the range %d-%d of %s: HTTP %d" % (start, end, self.url, r.status_code))
+
+		try:
+			context = self.decryptor.at(start) if self.decryptor else None
+			with open(self.output_file, "r+b") as f:
+				f.seek(start)
+				offset = self._write_response(_response_readinto(r), f, start, context)
+		finally:
+			_release(r)
+
+		if offset != end + 1:
+			raise ValueError("Incomplete range %d-%d of %s: %d bytes received" % (start, end, self.url, offset - start))
+		self.progress.segment(start, end, time.time() - start_time, _retries(r))
+		return start
+
+def _response_readinto(response):
+	""" A readinto function reading the body of a streamed response into a buffer
+
+		The body is read from the socket directly into the buffer when it is not encoded and the
+		underlying HTTP response supports it, without the intermediate bytes of urllib3.
+	"""
+	fp = getattr(response.raw, '_fp', None)
+	if response.headers.get('Content-Encoding', 'identity') == 'identity' and hasattr(fp, 'readinto'):
+		return fp.readinto
+	response.raw.decode_content = True
+	return response.raw.readinto
+
+def _fill(readinto, buffer):
+	""" Fill a buffer, returning the number of bytes read, less than the buffer size at the end of the body
+	"""
+	filled = 0
+	while filled < len(buffer):
+		size = readinto(buffer[filled:])
+		if not size:
+			break
+		filled += size
+	return filled
+
+def _release(response):
+	""" Give the connection of a response back to the pool if its body was fully read, close it otherwise
+	"""
+	fp = getattr(response.raw, '_fp', None)
+	if fp is not None and getattr(fp, 'isclosed', lambda: False)():
+		response.raw.release_conn()
+	response.close()
+
+def _retries(response):
+	""" Number of times the request of a response was retried by the HTTP adapter
+	"""
+	retries = getattr(response.raw, 'retries', None)
+	return len(retries.history) if retries is not None else 0
+
+class _OrderedDigest(object):
+	""" MD5 of a file whose parts are received out of order
+
+		Parts are hashed as soon as all the bytes before them are hashed. Parts received ahead are kept
+		in memory until then if they end within window bytes of the hashed bytes. Parts further ahead,
+		and parts already written before the download resumed, are read back from the file when they
+		are reached, so that a stalled range does not make the memory grow with the other ranges.
+
+		Args:
+			output_file (str):	The file being written, the parts must be flushed to it before they are added
+			window (int):		Maximum number of bytes kept in memory past the hashed bytes
+	"""
+
+	def __init__(self, output_file, window=DIGEST_WINDOW_SIZE):
+		self.output_file = output_file
+		self.window = window
+		self._md5 = hashlib.md5()
+		self._offset = 0
+		self._pending = {}
+		self._pending_size = 0
+		self._on_disk = {}
+		self._lock = threading.Lock()
+
+	def update(self, offset, data):
+		""" Add bytes received at an offset of the file
+		"""
+		with self._lock:
+			if offset == self._offset:
+				self._md5.update(data)
+				self._offset += len(data)
+			elif offset + len(data) - self._offset <= self.window and self._pending_size + len(data) <= self.window:
+				self._pending[offset] = memoryview(data).tobytes()
+				self._pending_size += len(data)
+			else:
+				self._on_disk[offset] = offset + len(data) - 1
+			self._drain()
+
+	def update_from_file(self, start, end):
+		""" Add a range already written to the file, read when all the bytes before it are hashed
+		"""
+		with self._lock:
+			self._on_disk[start] = end
+			self._drain()
+
+	def hexdigest(self):
+		with self._lock:
+			if self._pending or self._on_disk:
+				raise ValueError("MD5 of "+self.output_file+" is incomplete, bytes are missing at offset "+str(self._offset))
+			return self._md5.hexdigest()
+
+	def _drain(self):
+		while True:
+			if self._offset in self._pending:
+				data = self._pending.pop(self._offset)
+				self._pending_size -= len(data)
+				self._md5.update(data)
+				self._offset += len(data)
+			elif self._offset in self._on_disk:
+				end = self._on_disk.pop(self._offset)
+				with open(self.output_file, "rb") as f:
+					f.seek(self._offset)
+					while self._offset <= end:
+						data = f.read(min(DOWNLOAD_CHUNK_SIZE, end + 1 - self._offset))
+						if not data:
+							raise ValueError("Unexpected end of file "+self.output_file+" at offset "+str(self._offset))
+						self._md5.update(data)
+						self._offset += len(data)
+			else:
+				return
+
+class _Throttle(object):
+	""" Count the bytes transferred by several downloads and limit their total throughput
+
+		Args:
+			rate (float):	Maximum throughput in bytes per second, None for no limit
+	"""
 
+	def __init__(self, rate):
+		self.rate = rate
+		self.transferred = 0
+		self._next_time = time.time()
+		self._lock = threading.Lock()
+
+	def consume(self, size):
+		""" Record transferred bytes, waiting if the transfer is ahead of the maximum throughput
+		"""
+		with self._lock:
+			self.transferred += size
+			if not self.rate:
+				return
+			now = time.time()
+			self._next_time = max(self._next_time, now) + float(size) / self.rate
+			delay = self._next_time - now
+		if delay > 0:
+			time.sleep(delay)
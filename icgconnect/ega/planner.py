@@ -0,0 +1,212 @@
+"""
+Bulk submission of objects to the EGA submitter portal
+
+A SubmissionPlan holds the objects of a submission with references between them by alias. The plan
+orders the objects by their references and posts each layer of independent objects concurrently,
+replacing the references with the ids returned for the objects they point to.
+
+	plan = SubmissionPlan(submission_id)
+	sample = plan.add('samples', 'sample_1', {'title': 'Sample 1', 'genderId': gender_id, ...})
+	experiment = plan.add('experiments', 'experiment_1', {'sampleId': sample, 'studyId': study_id, ...})
+	plan.add('runs', 'run_1', {'sampleId': sample, 'experimentId': experiment, ...})
+	errors = plan.validate()
+	report = plan.run(session_token)
+
+The payloads use the field names of the portal, as built by the *_post functions of ega.submission.
+"""
+
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+from icgconnect.ega import submission
+from icgconnect.ega.session import call
+
+__all__ = ['Ref', 'SubmissionPlan']
+
+SUBMISSION_WORKERS = 8 # objects posted concurrently
+OBJECT_TYPES = ['studies', 'samples', 'experiments', 'runs', 'analyses', 'dacs', 'policies', 'datasets']
+
+class Ref(object):
+	""" A reference to an object of a plan, replaced by the id of the object when it is posted
+
+		Args:
+			alias (str):	The alias of the object
+	"""
+
+	__slots__ = ('alias',)
+
+	def __init__(self, alias):
+		self.alias = alias
+
+	def __eq__(self, other):
+		return isinstance(other, Ref) and other.alias == self.alias
+
+	def __ne__(self, other):
+		return not self == other
+
+	def __hash__(self):
+		return hash(self.alias)
+
+	def __repr__(self):
+		return 'Ref('+repr(self.alias)+')'
+
+class SubmissionPlan(object):
+	""" The objects of a submission, posted in the order of their references
+
+		Args:
+			submission_id (str):	The id of the submission the objects are added to
+	"""
+
+	def __init__(self, submission_id):
+		self.submission_id = submission_id
+		self._objects = OrderedDict()
+
+	def add(self, object_type, alias, data):
+		""" Add an object to the plan
+
+			Args:
+				object_type (str):	studies, samples, experiments, runs, analyses, dacs, policies or datasets
+				alias (str):		The alias of the object, unique in the plan
+				data (dict):		The payload of the object. Ref values, also in lists and nested dicts, are replaced by ids
+
+			Returns:
+				Ref:	A reference to the object, for the payloads of the objects depending on it
+
+			Raises:
+				ValueError:	An invalid object type or an alias already in the plan
+		"""
+		if not object_type in OBJECT_TYPES:
+			raise ValueError("Object "+str(object_type)+" is not valid. "+', '.join(OBJECT_TYPES))
+		if alias in self._objects:
+			raise ValueError("Alias "+alias+" is already in the plan")
+		data = dict(data)
+		data['alias'] = alias
+		self._objects[alias] = (object_type, data)
+		return Ref(alias)
+
+	def layers(self, known_ids=None):
+		""" The aliases of the objects grouped in layers, each object depending only on objects of the previous layers
+
+			Args:
+				known_ids (dict):	Ids of objects already posted by alias, which are left out of the layers
+
+			Returns:
+				list:	The layers, lists of aliases
+
+			Raises:
+				ValueError:	A reference to an unknown alias or a cycle of references
+		"""
+		known_ids = known_ids or {}
+		dependencies = {}
+		for alias, (_, data) in self._objects.items():
+			if alias in known_ids:
+				continue
+			dependencies[alias] = set()
+			for reference in _references(data):
+				if reference.alias in known_ids:
+					continue
+				if not reference.alias in self._objects:
+					raise ValueError("Object "+alias+" references the unknown alias "+reference.alias)
+				dependencies[alias].add(reference.alias)
+
+		layers = []
+		done = set()
+		while dependencies:
+			layer = [alias for alias in self._objects if alias in dependencies and dependencies[alias] <= done]
+			if not layer:
+				raise ValueError("Cyclic references between the objects "+', '.join(sorted(dependencies)))
+			for alias in layer:
+				del dependencies[alias]
+			done.update(layer)
+			layers.append(layer)
+		return layers
+
+	def validate(self, existing_ids=None, check_enums=True):
+		""" Validate the payloads of the plan offline, see ega.validation.validate_objects
+
+			Args:
+				existing_ids (set):		Ids and aliases of the objects already submitted, None to accept any string reference
+				check_enums (bool):		False to skip the enumeration tags
+
+			Returns:
+				dict:	The error messages of each invalid object by alias
+		"""
+		from icgconnect.ega.validation import validate_objects
+		errors = validate_objects(self._objects.values(), existing_ids, check_enums)
+		return dict((alias, messages) for alias, messages in zip(self._objects, errors) if messages)
+
+	def run(self, session, workers=SUBMISSION_WORKERS, known_ids=None, index=None, update=False):
+		""" Post the objects of the plan, each layer concurrently
+
+			An object that fails to be posted does not stop the others, but the objects referencing it are
+			not posted. Running the plan again with the ids of the report as known ids only posts the rest.
+
+			With an index of the submitted objects (ega.submission.AliasIndex), the objects whose alias is
+			already submitted are not posted again, or are edited with update. A failed run can then be
+			run again without known ids.
+
+			Args:
+				session:			A session token or an ega.Session
+				workers (int):		Number of objects posted concurrently
+				known_ids (dict):	Ids of objects already posted by alias, e.g. the ids of a previous run
+				index (AliasIndex):	The submitted objects, None to post all the objects
+				update (bool):		True to edit the objects of the index instead of skipping them
+
+			Returns:
+				dict:	The ids of the objects by alias (including the known ids), the error of each failed
+						object by alias and the aliases of the objects not posted because of a failed reference
+		"""
+		report = {'ids': dict(known_ids or {}), 'failed': {}, 'skipped': []}
+		layers = self.layers(report['ids'])
+		pool = ThreadPool(max(1, workers))
+		try:
+			for layer in layers:
+				ready = []
+				for alias in layer:
+					if any(reference.alias in report['failed'] or reference.alias in report['skipped'] for reference in _references(self._objects[alias][1])):
+						report['skipped'].append(alias)
+					else:
+						ready.append(alias)
+				for alias, object_id, error in pool.imap_unordered(lambda alias: self._post(session, alias, report['ids'], index, update), ready):
+					if error is None:
+						report['ids'][alias] = object_id
+					else:
+						report['failed'][alias] = error
+		finally:
+			pool.close()
+			pool.join()
+		return report
+
+	def _post(self, session, alias, ids, index=None, update=False):
+		object_type, data = self._objects[alias]
+		try:
+			if index is None:
+				return alias, call(session, submission._objects_post, object_type, self.submission_id, _resolve(data, ids)).get('id'), None
+			post = submission.objects_create_or_update if update else submission.objects_create_or_skip
+			return alias, call(session, post, object_type, self.submission_id, _resolve(data, ids), index), None
+		except Exception as err:
+			return alias, None, str(err)
+
+def _references(value):
+	""" The references in a payload
+	"""
+	if isinstance(value, Ref):
+		yield value
+	elif isinstance(value, dict):
+		for item in value.values():
+			for reference in _references(item):
+				yield reference
+	elif isinstance(value, (list, tuple)):
+		for item in value:
+			for reference in _references(item):
+				yield reference
+
+def _resolve(value, ids):
+	""" A copy of a payload with the references replaced by ids
+	"""
+	if isinstance(value, Ref):
+		return ids[value.alias]
+	if isinstance(value, dict):
+		return dict((key, _resolve(item, ids)) for key, item in value.items())
+	if isinstance(value, (list, tuple)):
+		return [_resolve(item, ids) for item in value]
+	return value
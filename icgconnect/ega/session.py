@@ -0,0 +1,139 @@
+"""
+Session tokens of the EGA APIs
+
+A Session logs in to the EGA download or submission API when its token is first needed, shares the
+token between threads (and processes, through an optional token file) and logs in again when
+EGA reports that the token expired.
+"""
+
+import hashlib
+import json
+import os
+import threading
+from icgconnect.utils import file_utils
+
+__all__ = ['EgaResponseError', 'Session', 'call']
+
+SESSION_EXPIRED_CODES = ('401', '403') # EGA response codes of an expired or invalid session token
+
+class EgaResponseError(ValueError):
+	""" An error response of an EGA API
+
+		Args:
+			message (str):	The user message of the response
+			code (str):		The code of the response
+	"""
+
+	def __init__(self, message, code=None):
+		super(EgaResponseError, self).__init__(message)
+		self.code = code
+
+	def is_session_expired(self):
+		""" Check if the error is caused by an expired or invalid session token
+
+			Returns:
+				bool:	True if logging in again may solve the error
+		"""
+		message = str(self).lower()
+		return self.code in SESSION_EXPIRED_CODES or \
+			('session' in message and any(word in message for word in ('expired', 'invalid', 'not valid')))
+
+class Session(object):
+	""" A session token of an EGA API, logged in lazily and renewed when it expires
+
+		The session can be shared by threads. With a token file, processes logging in with the same
+		credentials also share their token instead of logging in each.
+
+			session = Session(icgconnect.ega.download.login, email, password, token_file='~/.ega_tokens')
+			files = session.call(icgconnect.ega.download.files_index, 'EGAD00001000001')
+
+		Args:
+			login (function):	The login function of the API, taking the username and password and returning a token
+			username (str):		The username or email address
+			password (str):		The password
+			token_file (str):	A JSON file caching the tokens, None to keep the token in memory only
+	"""
+
+	def __init__(self, login, username, password, token_file=None):
+		self._login = login
+		self.username = username
+		self._password = password
+		self.token_file = os.path.expanduser(token_file) if token_file else None
+		self._key = hashlib.sha1((login.__module__+'\n'+username).encode('utf-8')).hexdigest()
+		self._token = None
+		self._lock = threading.Lock()
+
+	@property
+	def token(self):
+		""" The session token, logging in if there is none yet
+		"""
+		with self._lock:
+			if self._token is None:
+				self._token = self._read_token_file() or self._new_token()
+			return self._token
+
+	def call(self, function, *args, **kwargs):
+		""" Call an API function with the session token, logging in again and retrying once if the token expired
+
+			Args:
+				function:	A function taking the session token as its first argument
+				args:		The other arguments of the function
+				kwargs:		The keyword arguments of the function
+
+			Returns:
+				The result of the function
+		"""
+		token = self.token
+		try:
+			return function(token, *args, **kwargs)
+		except EgaResponseError as err:
+			if not err.is_session_expired():
+				raise
+			self.renew(token)
+			return function(self.token, *args, **kwargs)
+
+	def renew(self, expired_token):
+		""" Replace an expired token, unless another thread or process already did
+
+			Args:
+				expired_token (str):	The token that expired
+		"""
+		with self._lock:
+			if self._token != expired_token:
+				return
+			token = self._read_token_file()
+			self._token = token if token and token != expired_token else self._new_token()
+
+	def _new_token(self):
+		token = self._login(self.username, self._password)
+		if self.token_file:
+			tokens = self._read_token_file(all_tokens=True)
+			tokens[self._key] = token
+			file_utils.write_json(self.token_file, tokens)
+		return token
+
+	def _read_token_file(self, all_tokens=False):
+		tokens = {}
+		if self.token_file and os.path.isfile(self.token_file):
+			try:
+				with open(self.token_file, 'r') as f:
+					tokens = json.load(f)
+			except ValueError:
+				tokens = {}
+		return tokens if all_tokens else tokens.get(self._key)
+
+def call(session, function, *args, **kwargs):
+	""" Call an API function with a session token or a Session
+
+		Args:
+			session:	A session token or a Session, logging in again if the token expired
+			function:	A function taking the session token as its first argument
+			args:		The other arguments of the function
+			kwargs:		The keyword arguments of the function
+
+		Returns:
+			The result of the function
+	"""
+	if isinstance(session, Session):
+		return session.call(function, *args, **kwargs)
+	return function(session, *args, **kwargs)
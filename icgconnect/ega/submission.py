@@ -1,8 +1,24 @@
 
-import requests, json
+import json
+import os
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+from icgconnect.utils import file_utils
+from icgconnect.utils import http_utils
+from icgconnect.ega.session import EgaResponseError, Session
 
 api_access_url = "https://ega.crg.eu/submitterportal/v1"
 
+ENUMS = ['analysis_file_types','analysis_types','case_control','dataset_types','experiment_types','file_types','genders','instrument_models','library_selections','library_sources','library_strategies',
+	'reference_chromosomes','reference_genomes','study_types']
+ENUM_CACHE_FILE = os.environ.get('ICGCONNECT_EGA_ENUM_CACHE_FILE') # file persisting the enumerations between processes
+ENUM_TTL = 7 * 24 * 3600 # seconds before the persisted enumerations are downloaded again
+ENUM_WORKERS = len(ENUMS) # enumerations downloaded concurrently
+OBJECT_TYPES = ['studies','samples','experiments','runs','analyses','dacs','policies','datasets']
+INDEX_WORKERS = 4 # object types indexed concurrently by AliasIndex.build
+INDEX_PAGE_SIZE = 1000 # objects requested per page by iter_objects
+
 
 def login(username, password):
 	""" Login to the ega submission api
@@ -23,7 +39,20 @@ def login(username, password):
 		"loginType": "submitter"
 	}
 
-	return str(_result_from_response(requests.post(_api_access_endpoint('/login'), data=payload))[0]['session']['sessionToken'])
+	return str(_result_from_response(http_utils.post(_api_access_endpoint('/login'), data=payload))[0]['session']['sessionToken'])
+
+def create_session(username, password, token_file=None):
+	""" Create a session of the ega submission api, logging in when the token is first used and again when it expires
+
+		Args:
+			username:	username of the ega-box
+			password:	password for the username
+			token_file:	a file caching the token for other processes, None to keep it in memory
+
+		Returns:
+			Session: A session calling the functions of this module, e.g. session.call(submission.studies_index)
+	"""
+	return Session(login, username, password, token_file)
 
 def logout(session_token):
 	""" Logout form the ega api
@@ -35,7 +64,7 @@ def logout(session_token):
 			dict: Logout server response
 	"""
 	_validate_session_token(session_token)
-	return _result_from_response(requests.delete(_api_access_endpoint('/logout'),headers=_session_headers(session_token)))[0]['session'] == None
+	return _result_from_response(http_utils.delete(_api_access_endpoint('/logout'),headers=_session_headers(session_token)))[0]['session'] == None
 
 def studies_index(session_token,status=None):
 	""" Index all accessible studies
@@ -47,23 +76,22 @@ def studies_index(session_token,status=None):
 		Returns:
 			dict:	All accessible studies
 	"""
-	studies = _objects_index(session_token,'studies',status)
 	output = []
 
-	for i in xrange(0, len(studies)):
+	for study in iter_objects(session_token,'studies',status):
 		tags = []
-		for j in xrange(0,len(studies[i].get('customTags'))):
-			tags.append({'tag':studies[i].get('customTags')[j].get('tag'),
-						 'value': studies[i].get('customTags')[j].get('value')})
-
-		output.append({'alias': studies[i].get('alias'),
-						'id':studies[i].get('id'),
-					   'study_type_id':studies[i].get('studyTypeId'),
-					   'short_name':studies[i].get('shortName'),
-					   'title': studies[i].get('title'),
-					   'study_abstract': studies[i].get('studyAbstract'),
-					   'own_term': studies[i].get('ownTerm'),
-					   'pubmed_ids': studies[i].get('pubmedIds'),
+		for tag in study.get('customTags') or []:
+			tags.append({'tag':tag.get('tag'),
+						 'value': tag.get('value')})
+
+		output.append({'alias': study.get('alias'),
+						'id':study.get('id'),
+					   'study_type_id':study.get('studyTypeId'),
+					   'short_name':study.get('shortName'),
+					   'title': study.get('title'),
+					   'study_abstract': study.get('studyAbstract'),
+					   'own_term': study.get('ownTerm'),
+					   'pubmed_ids': study.get('pubmedIds'),
 					   'custom_tags': tags})
 
 	return output
@@ -139,12 +167,11 @@ def samples_index(session_token, status=None):
 		Returns:
 			dict:	A list of samples
 	"""
-	samples = _objects_index(session_token,'samples',status)
 	output = []
 
-	for sample in samples:
+	for sample in iter_objects(session_token,'samples',status):
 		attributes = []
-		for attribute in sample.get('attributes'):
+		for attribute in sample.get('attributes') or []:
 			attributes.append({'tag': attribute.get('tag'), 'value': attribute.get('value')})
 		output.append({'id': sample.get('id'),
 					   'alias': sample.get('alias'),
@@ -612,6 +639,204 @@ def submissions_put(session_token, submission_id, title=None, description=None,
 
 	return _objects_put(session_token, 'submissions', submission_id, data)
 
+def iter_objects(session_token, object_type, status=None, submission_id=None, page_size=INDEX_PAGE_SIZE, skip=0, limit=None):
+	""" Iterate over the objects of a type, one page at a time
+
+		The objects are requested by pages of page_size objects, filtered by status by the portal. Their
+		JSON is only decoded when a field of a record is read, so that memory holds one page of raw JSON.
+
+		Some indexes are not paged by the portal, which then ignores skip and limit. With skip, the first
+		page is compared with the first object of the index, one more request, to skip the objects locally.
+
+		Args:
+			session_token:	A valid session token
+			object_type:	The type of objects to index
+			status:			A status to filter the objects
+			submission_id:	A submission id for filtering
+			page_size:		Objects requested per page, None to request all the objects at once
+			skip:			Number of objects to skip
+			limit:			Maximum number of objects, None for all the objects
+
+		Raises:
+			ValueError:	An invalid session token, object type or status
+
+		Returns:
+			iterator:	ObjectRecord of each object
+	"""
+	_validate_session_token(session_token)
+	if not object_type in OBJECT_TYPES+['submissions']:
+		raise ValueError("Object "+str(object_type)+" is not valid. "+', '.join(OBJECT_TYPES+['submissions']))
+	if status != None:
+		status = status.upper()
+		_validate_status(status)
+
+	count = 0
+	first_json = None
+	while limit is None or count < limit:
+		size = page_size if limit is None else min(page_size or limit, limit - count)
+		page = _objects_page(session_token, object_type, status, submission_id, skip + count, size)
+		if not size:
+			# All the objects were requested at once, without skip
+			page = page[skip:]
+		elif len(page) > size:
+			# The portal does not page this index and returned all the objects
+			page = page[skip + count:] if limit is None else page[skip + count:skip + limit]
+		elif page:
+			# A portal not paging an index of exactly size objects returns the same page again
+			if count and page[0]['json'] == first_json:
+				return
+			first_json = page[0]['json']
+			if not count and skip and [result['json'] for result in _objects_page(session_token, object_type, status, submission_id, 0, 1)[:1]] == [first_json]:
+				# The page starts with the first object, the portal ignored skip and returned all the objects
+				page = page[skip:]
+		for result in page:
+			yield ObjectRecord(result['json'])
+			count += 1
+		if not size or len(page) != size:
+			return
+
+class ObjectRecord(object):
+	""" An object of an index, its JSON decoded on first access
+
+		Args:
+			json_text:	The JSON of the object, as returned by the portal
+	"""
+
+	__slots__ = ('_json', '_data')
+
+	def __init__(self, json_text):
+		self._json = json_text
+		self._data = None
+
+	@property
+	def data(self):
+		""" The decoded object
+		"""
+		if self._data is None:
+			self._data = json.loads(self._json)
+			self._json = None
+		return self._data
+
+	def get(self, key, default=None):
+		return self.data.get(key, default)
+
+	def __getitem__(self, key):
+		return self.data[key]
+
+	@property
+	def id(self):
+		return self.data.get('id')
+
+	@property
+	def alias(self):
+		return self.data.get('alias')
+
+	@property
+	def status(self):
+		return self.data.get('status')
+
+def objects_create_or_skip(session_token, object_type, submission_id, data, index):
+	""" Post an object unless an object of the same type and alias exists
+
+		Args:
+			session_token:	A valid session token
+			object_type:	The type of the object
+			submission_id:	A valid submission id
+			data:			The payload of the object, with its alias
+			index:			An AliasIndex of the existing objects, updated with the posted object
+
+		Returns:
+			str:	The id of the existing or posted object
+	"""
+	object_id = index.get(object_type, data.get('alias'))
+	if object_id is None:
+		object_id = _objects_post(session_token, object_type, submission_id, data).get('id')
+		index.add(object_type, data.get('alias'), object_id)
+	return object_id
+
+def objects_create_or_update(session_token, object_type, submission_id, data, index):
+	""" Post an object, or edit the object of the same type and alias if it exists
+
+		Args:
+			session_token:	A valid session token
+			object_type:	The type of the object
+			submission_id:	A valid submission id
+			data:			The payload of the object, with its alias
+			index:			An AliasIndex of the existing objects, updated with the posted object
+
+		Returns:
+			str:	The id of the updated or posted object
+	"""
+	object_id = index.get(object_type, data.get('alias'))
+	if object_id is None:
+		return objects_create_or_skip(session_token, object_type, submission_id, data, index)
+	_objects_put(session_token, object_type, object_id, data)
+	return object_id
+
+class AliasIndex(object):
+	""" The ids of submitted objects by type and alias
+
+		Args:
+			ids:	The ids by alias of each object type, e.g. {'samples': {'sample_1': 'EGAN00001'}}
+	"""
+
+	def __init__(self, ids=None):
+		self._ids = dict((object_type, dict(aliases)) for object_type, aliases in (ids or {}).items())
+		self._lock = threading.Lock()
+
+	@classmethod
+	def build(cls, session_token, object_types=OBJECT_TYPES, submission_id=None, workers=INDEX_WORKERS):
+		""" Index the objects of the user, with one request per object type
+
+			Args:
+				session_token:	A valid session token
+				object_types:	The types of the objects to index
+				submission_id:	A submission id for filtering
+				workers:		Number of object types indexed concurrently
+
+			Returns:
+				AliasIndex:	The index
+		"""
+		object_types = list(object_types)
+		pool = ThreadPool(max(1, min(workers, len(object_types))))
+		try:
+			indexes = pool.map(lambda object_type: dict((record.alias, record.id) for record in iter_objects(session_token, object_type, submission_id=submission_id)
+															if record.alias is not None), object_types)
+		finally:
+			pool.close()
+			pool.join()
+		return cls(dict(zip(object_types, indexes)))
+
+	def get(self, object_type, alias):
+		""" The id of an object
+
+			Args:
+				object_type:	The type of the object
+				alias:			The alias of the object
+
+			Returns:
+				str:	The id, None if there is no object of the type with the alias
+		"""
+		return self._ids.get(object_type, {}).get(alias)
+
+	def add(self, object_type, alias, object_id):
+		""" Record the id of an object
+		"""
+		with self._lock:
+			self._ids.setdefault(object_type, {})[alias] = object_id
+
+	def ids(self, object_type):
+		""" The ids of the objects of a type by alias
+		"""
+		return dict(self._ids.get(object_type, {}))
+
+	def __contains__(self, key):
+		object_type, alias = key
+		return self.get(object_type, alias) is not None
+
+	def __len__(self):
+		return sum(len(aliases) for aliases in self._ids.values())
+
 def enum_analysis_file_types():
 	""" Enumeration of analysis file types
 
@@ -724,9 +949,142 @@ def enum_study_types():
 	"""
 	return _get_enum('study_types')
 
+def enum_tag(_type, value):
+	""" The tag (id) of a value of an enumeration, e.g. enum_tag('genders', 'male')
+
+		Args:
+			_type:	The name of the enumeration
+			value:	The value, case insensitive
+
+		Raises:
+			ValueError:	The value is not in the enumeration
+
+		Returns:
+			str:	The tag of the value
+	"""
+	return _enums.tag(_type, value)
+
+def enum_value(_type, tag):
+	""" The value of a tag (id) of an enumeration
+
+		Args:
+			_type:	The name of the enumeration
+			tag:	The tag
+
+		Raises:
+			ValueError:	The tag is not in the enumeration
+
+		Returns:
+			str:	The value of the tag
+	"""
+	return _enums.value(_type, tag)
+
+def configure_enums(cache_file=None, ttl=ENUM_TTL):
+	""" Persist the enumerations to a file, shared by the processes using the same file
+
+		Args:
+			cache_file:	The JSON file, None to keep the enumerations in memory only
+			ttl:		Seconds before the persisted enumerations are downloaded again
+	"""
+	global _enums
+	_enums = EnumRegistry(cache_file, ttl)
+
+def clear_enums():
+	""" Forget the enumerations, downloaded again when they are next used
+	"""
+	_enums.clear()
+
+class EnumRegistry(object):
+	""" The enumerations of the submitter portal, downloaded once and concurrently
+
+		Args:
+			cache_file:	A JSON file persisting the enumerations, None to keep them in memory only
+			ttl:		Seconds before the persisted enumerations are downloaded again
+	"""
+
+	def __init__(self, cache_file=None, ttl=ENUM_TTL):
+		self.cache_file = cache_file
+		self.ttl = ttl
+		self._enums = None
+		self._tags = None
+		self._values = None
+		self._lock = threading.Lock()
+
+	def get(self, _type):
+		""" An enumeration, as returned by the portal
+
+			Args:
+				_type:	The name of the enumeration
+
+			Raises:
+				ValueError: The _type has to be in the available list
+
+			Returns:
+				list:	A copy of the entries of the enumeration, which can be modified without changing the cache
+		"""
+		if not _type in ENUMS:
+			raise ValueError("Invalid enum: "+', '.join(ENUMS))
+		return [dict(entry) for entry in self._load()[0][_type]]
+
+	def tag(self, _type, value):
+		""" The tag of a value of an enumeration, see enum_tag
+		"""
+		if not _type in ENUMS:
+			raise ValueError("Invalid enum: "+', '.join(ENUMS))
+		tag = self._load()[1][_type].get(str(value).lower())
+		if tag is None:
+			raise ValueError("Invalid value of "+_type+": "+str(value))
+		return tag
+
+	def value(self, _type, tag):
+		""" The value of a tag of an enumeration, see enum_value
+		"""
+		if not _type in ENUMS:
+			raise ValueError("Invalid enum: "+', '.join(ENUMS))
+		value = self._load()[2][_type].get(str(tag))
+		if value is None:
+			raise ValueError("Invalid tag of "+_type+": "+str(tag))
+		return value
+
+	def clear(self):
+		with self._lock:
+			self._enums = None
+
+	def _load(self):
+		with self._lock:
+			if self._enums is None:
+				enums = self._read_cache_file()
+				if enums is None:
+					pool = ThreadPool(ENUM_WORKERS)
+					try:
+						enums = dict(zip(ENUMS, pool.map(_download_enum, ENUMS)))
+					finally:
+						pool.close()
+						pool.join()
+					if self.cache_file:
+						file_utils.write_json(self.cache_file, {'time': time.time(), 'enums': enums})
+				self._tags = dict((_type, dict((str(entry.get('value')).lower(), entry.get('tag')) for entry in entries)) for _type, entries in enums.items())
+				self._values = dict((_type, dict((str(entry.get('tag')), entry.get('value')) for entry in entries)) for _type, entries in enums.items())
+				self._enums = enums
+			return self._enums, self._tags, self._values
+
+	def _read_cache_file(self):
+		if not self.cache_file or not os.path.isfile(self.cache_file):
+			return None
+		try:
+			with open(self.cache_file, 'r') as f:
+				cache = json.load(f)
+		except ValueError:
+			return None
+		if time.time() - cache.get('time', 0) > self.ttl or set(cache.get('enums', {})) != set(ENUMS):
+			return None
+		return cache['enums']
+
 def _get_enum(_type):
 	""" Return a specific enumeration - Generic
 
+		The enumerations are downloaded once, see EnumRegistry.
+
 		Args:
 			_type:	The name of the enumeration
 
@@ -736,13 +1094,18 @@ def _get_enum(_type):
 		Returns:
 			dict:	List an enumeration
 	"""
-	enums = ['analysis_file_types','analysis_types','case_control','dataset_types','experiment_types','file_types','genders','instrument_models','library_selections','library_sources','library_strategies',
-	'reference_chromosomes','reference_genomes','study_types']
-	
-	if not _type in enums:
-		raise ValueError("Invalid enum: "+', '.join(enums))
+	return _enums.get(_type)
 
-	return _result_from_response(requests.get(_api_access_endpoint('/enums/'+_type)))
+def _download_enum(_type):
+	""" Download an enumeration from the portal
+
+		Args:
+			_type:	The name of the enumeration
+
+		Returns:
+			list:	The entries of the enumeration
+	"""
+	return _result_from_response(http_utils.get(_api_access_endpoint('/enums/'+_type)))
 
 
 def _objects_index(session_token, object_type,status=None, submission_id=None):
@@ -761,30 +1124,36 @@ def _objects_index(session_token, object_type,status=None, submission_id=None):
 		Returns:
 			dict:	The index of requested object type available
 	"""
-	_validate_session_token(session_token)
+	return [record.data for record in iter_objects(session_token, object_type, status, submission_id)]
+
+def _objects_page(session_token, object_type, status=None, submission_id=None, skip=0, limit=None):
+	""" A page of the index of an object type, with the JSON of the objects not decoded
+
+		Args:
+			session_token: 	A valid session token
+			object_type:	The type of object to index
+			status:			A status to filter the index
+			submission_id:	A submission id for filtering
+			skip:			Number of objects to skip
+			limit:			Maximum number of objects, None for all the objects
+
+		Returns:
+			list:	The results of the portal, with the JSON of each object in the json key
+	"""
 	url = '/'
 
 	if submission_id!=None:
 		url = '/submissions/'+submission_id+"/"
 
-	object_types = ['studies','samples','submissions','datasets','experiments','analyses','dacs','policies','runs']
-
-	if not object_type in object_types:
-		raise ValueError("Object "+object_type+" is not valid. "+', '.join(object_types))
-
-	objects = []
-	if status == None:
-		r = _result_from_response(requests.get(_api_access_endpoint(url+object_type), headers=_session_headers(session_token)))
-		if(len(r)>0):
-			for tmp_r in r:
-				objects.append(json.loads(tmp_r['json']))
-			return objects
-	else:
-		r = _result_from_response(requests.get(_api_access_endpoint(url+object_type+'?status='+status.upper()), headers=_session_headers(session_token)))
-		if(len(r)>0):
-			for tmp_r in r:
-				objects.append(json.loads(tmp_r['json']))
-			return objects
+	parameters = []
+	if status != None:
+		parameters.append('status='+status)
+	if limit:
+		parameters.append('skip='+str(skip))
+		parameters.append('limit='+str(limit))
+
+	query = '?'+'&'.join(parameters) if parameters else ''
+	return _result_from_response(http_utils.get(_api_access_endpoint(url+object_type+query), headers=_session_headers(session_token))) or []
 
 def _objects_get(session_token,object_type,id_type,id, submission_id=None):
 	""" Retrieve a specific object - Generic
@@ -801,7 +1170,7 @@ def _objects_get(session_token,object_type,id_type,id, submission_id=None):
 	"""
 	_validate_session_token(session_token)
 	validate_id_type(id_type)
-	return json.loads(_result_from_response(requests.get(_api_access_endpoint('/'+object_type+'/'+id+'?idtype='+id_type), headers=_session_headers(session_token)))[0]['json'])
+	return json.loads(_result_from_response(http_utils.get(_api_access_endpoint('/'+object_type+'/'+id+'?idtype='+id_type), headers=_session_headers(session_token)))[0]['json'])
 
 def _objects_post(session_token,object_type,submission_id, json_data):
 	""" Save a specific object - Generic
@@ -821,14 +1190,14 @@ def _objects_post(session_token,object_type,submission_id, json_data):
 	if not object_type == None:
 		url_string = url_string + "/" + submission_id + "/" + object_type
 
-	return _result_from_response(requests.post(_api_access_endpoint(url_string), json=json_data, headers=_session_headers(session_token)))[0]
+	return _result_from_response(http_utils.post(_api_access_endpoint(url_string), json=json_data, headers=_session_headers(session_token)))[0]
 
 def _objects_put(session_token, object_type, object_id, json_data):
 	_validate_session_token(session_token);
 
 	url_string = '/'+object_type+"/"+object_id+"?action=EDIT"
 
-	return _result_from_response(requests.put(_api_access_endpoint(url_string),json=json_data, headers=_session_headers(session_token)))[0]
+	return _result_from_response(http_utils.put(_api_access_endpoint(url_string),json=json_data, headers=_session_headers(session_token)))[0]
 
 def _session_headers(session_token):
 	""" Generate the session header with the session token
@@ -899,10 +1268,10 @@ def _validate_response(json_response):
 			json_response:	A json response from EGA
 
 		Raises:
-			ValueError:	An invalid json response
+			EgaResponseError:	An invalid json response
 	"""
 	if json_response['header']['code'] != "200":
-		raise ValueError(json_response['header']['userMessage'])
+		raise EgaResponseError(json_response['header']['userMessage'], json_response['header']['code'])
 
 def _validate_session_token(session_token):
 	""" Validate a session token
@@ -915,3 +1284,5 @@ def _validate_session_token(session_token):
 	"""
 	if session_token == None:
 		raise ValueError("EGA session token is empty")
+
+_enums = EnumRegistry(ENUM_CACHE_FILE)
@@ -0,0 +1,134 @@
+"""
+Offline validation of EGA submission payloads
+
+Checks a batch of payloads before they are posted: required fields, enumeration tags, statuses,
+aliases, files and references between the objects of the batch. All the errors are reported at once,
+without a request per object. Only the enumerations are downloaded, once, by ega.submission.
+
+	errors = validate_objects([('samples', sample), ('experiments', experiment)])
+"""
+
+import re
+from icgconnect.ega import submission
+from icgconnect.ega.planner import Ref
+
+__all__ = ['validate_objects']
+
+REQUIRED_FIELDS = {
+	'studies': ['alias', 'studyTypeId', 'title', 'studyAbstract'],
+	'samples': ['alias', 'title', 'caseOrControlId', 'genderId', 'phenotype', 'subjectId'],
+	'experiments': ['alias', 'title', 'instrumentModelId', 'librarySourceId', 'librarySelectionId', 'libraryStrategyId',
+					'designDescription', 'libraryLayoutId', 'sampleId', 'studyId'],
+	'runs': ['alias', 'sampleId', 'runFileTypeId', 'experimentId', 'files'],
+	'analyses': ['alias', 'title', 'description', 'studyId', 'analysisTypeId', 'files'],
+	'dacs': ['alias', 'title', 'contacts'],
+	'policies': ['alias', 'dacId', 'title', 'policyText'],
+	'datasets': ['alias', 'title', 'datasetTypeIds', 'policyId']
+}
+
+# Fields holding tags of an enumeration
+ENUM_FIELDS = {
+	'studies': {'studyTypeId': 'study_types'},
+	'samples': {'caseOrControlId': 'case_control', 'genderId': 'genders'},
+	'experiments': {'instrumentModelId': 'instrument_models', 'librarySourceId': 'library_sources',
+					'librarySelectionId': 'library_selections', 'libraryStrategyId': 'library_strategies'},
+	'runs': {'runFileTypeId': 'file_types'},
+	'analyses': {'analysisTypeId': 'analysis_types', 'genomeId': 'reference_genomes', 'experimentTypeId': 'experiment_types'},
+	'datasets': {'datasetTypeIds': 'dataset_types'}
+}
+
+# Fields holding references to other objects, by type of the referenced objects
+REFERENCE_FIELDS = {
+	'experiments': {'sampleId': 'samples', 'studyId': 'studies'},
+	'runs': {'sampleId': 'samples', 'experimentId': 'experiments'},
+	'analyses': {'studyId': 'studies'},
+	'policies': {'dacId': 'dacs'},
+	'datasets': {'runsReferences': 'runs', 'analysisReferences': 'analyses', 'policyId': 'policies'}
+}
+
+FILE_FIELDS = ['fileName', 'checksum', 'unencryptedChecksum']
+
+_MD5 = re.compile('^[0-9a-fA-F]{32}$')
+
+def validate_objects(objects, existing_ids=None, check_enums=True):
+	""" Validate a batch of submission payloads
+
+		References are Ref objects or strings. A string referencing an alias of the batch must point to an
+		object of the right type. Other strings are ids or aliases of objects already submitted, checked
+		against existing_ids when it is given.
+
+		Args:
+			objects (list):			Tuples of the object type (studies, samples, ...) and the payload
+			existing_ids (set):		Ids and aliases of the objects already submitted, None to accept any string reference
+			check_enums (bool):		False to skip the enumeration tags, which are downloaded once otherwise
+
+		Returns:
+			list:	The error messages of each payload, in the order of the payloads. Valid payloads have no error
+	"""
+	objects = list(objects)
+	types_by_alias = {}
+	for object_type, data in objects:
+		types_by_alias.setdefault(data.get('alias'), set()).add(object_type)
+	enum_tags = _enum_tags() if check_enums else None
+
+	aliases = set()
+	errors = []
+	for object_type, data in objects:
+		messages = []
+		if not object_type in REQUIRED_FIELDS:
+			errors.append(["Object type "+str(object_type)+" is not valid. "+', '.join(sorted(REQUIRED_FIELDS))])
+			continue
+
+		for field in REQUIRED_FIELDS[object_type]:
+			if data.get(field) in (None, '', []):
+				messages.append(field+": is required")
+
+		if (object_type, data.get('alias')) in aliases:
+			messages.append("alias: "+str(data.get('alias'))+" is used by another object of the batch")
+		aliases.add((object_type, data.get('alias')))
+
+		if data.get('status') is not None:
+			try:
+				submission._validate_status(data['status'])
+			except ValueError as err:
+				messages.append("status: "+str(err))
+
+		if enum_tags is not None:
+			for field, enum in ENUM_FIELDS.get(object_type, {}).items():
+				for tag in _values(data.get(field)):
+					if not str(tag) in enum_tags[enum]:
+						messages.append(field+": "+str(tag)+" is not a tag of "+enum)
+
+		for field, referenced_type in REFERENCE_FIELDS.get(object_type, {}).items():
+			for reference in _values(data.get(field)):
+				alias = reference.alias if isinstance(reference, Ref) else reference
+				if alias in types_by_alias:
+					if not referenced_type in types_by_alias[alias]:
+						messages.append(field+": "+str(alias)+" is not an alias of "+referenced_type)
+				elif isinstance(reference, Ref) or (existing_ids is not None and not alias in existing_ids):
+					messages.append(field+": "+str(alias)+" is not a known object of "+referenced_type)
+
+		for index, _file in enumerate(data.get('files') or []):
+			for field in FILE_FIELDS:
+				if not _file.get(field):
+					messages.append("files[%d].%s: is required" % (index, field))
+			for field in ('checksum', 'unencryptedChecksum'):
+				if _file.get(field) and (_file.get('checksumMethod') or 'MD5').upper() == 'MD5' and not _MD5.match(_file[field]):
+					messages.append("files[%d].%s: %s is not a MD5" % (index, field, _file[field]))
+
+		errors.append(messages)
+	return errors
+
+def _enum_tags():
+	""" The tags of each enumeration, as sets of strings
+	"""
+	return dict((enum, set(str(entry.get('tag')) for entry in submission._get_enum(enum))) for enum in submission.ENUMS)
+
+def _values(value):
+	""" The values of a field holding a value or a list
+	"""
+	if value is None:
+		return []
+	if isinstance(value, (list, tuple)):
+		return value
+	return [value]
@@ -1,8 +1,12 @@
-import requests
 import json
 import re
 import os
 import subprocess
+from multiprocessing.pool import ThreadPool
+from icgconnect.utils import cache_utils
+from icgconnect.utils import file_utils
+from icgconnect.utils import http_utils
+from icgconnect.icgc import song
 
 ICGC_ID_SERVICE_URL_TEST = "http://hetl2-dcc.res.oicr.on.ca:9000" # dry run uses this
 ICGC_ID_SERVICE_URL_PROD = "https://id.icgc.org" # submit uses this
@@ -26,61 +30,246 @@ ICGC_ID_SERVICE_ENDPOINTS = {
     }
 }
 
+PROJECT_SAMPLES_CACHE_SIZE = 32 # number of projects kept in memory
+PROJECT_SAMPLES_CACHE_TTL = 3600 # seconds before a project samples listing is downloaded again
+DONOR_CACHE_SIZE = 10000
+DONOR_CACHE_TTL = 3600
+ID_SERVICE_BATCH_WORKERS = 8
+DONOR_SEARCH_PAGE_SIZE = 100 # donors requested per portal search call
+PORTAL_PAGE_SIZE = 100 # hits requested per page by the iter_* functions
+
+DONOR_FIELDS = ['project_id', 'gender', 'submitted_donor_id', 'icgc_sample_id', 'submitted_sample_id',
+                'submitted_specimen_id', 'specimen_type', 'specimen_class', 'library_strategy']
+
+_project_samples_cache = cache_utils.LRUCache(PROJECT_SAMPLES_CACHE_SIZE, PROJECT_SAMPLES_CACHE_TTL)
+_donor_cache = cache_utils.LRUCache(DONOR_CACHE_SIZE, DONOR_CACHE_TTL)
+
+class ProjectSampleIndex(object):
+    """ Index of the samples of a project
+
+        Maps the submitted donor, specimen and sample ids of the project to their ICGC ids and back,
+        with constant time lookups. An index can be saved to disk and loaded again without
+        downloading the project samples.
+
+        Args:
+            project_id (str):   An ICGC project code
+            columns (list):     The columns of the project samples TSV
+            rows (list):        The rows of the project samples TSV, as lists of values
+    """
+
+    def __init__(self, project_id, columns, rows):
+        self.project_id = project_id
+        self.columns = list(columns)
+        self.rows = [list(row) for row in rows]
+        self._donor_rows = {}
+        self._ids = {}
+        self._submitted_ids = {}
+
+        for entity in ('donor', 'specimen', 'sample'):
+            self._ids[entity] = {}
+            self._submitted_ids[entity] = {}
+
+        for row in self.rows:
+            values = dict(zip(self.columns, row))
+            self._donor_rows.setdefault(values.get('icgc_donor_id'), values)
+            for entity in ('donor', 'specimen', 'sample'):
+                icgc_id = values.get('icgc_'+entity+'_id')
+                submitted_id = values.get('submitted_'+entity+'_id')
+                self._ids[entity].setdefault(submitted_id, icgc_id)
+                self._submitted_ids[entity].setdefault(icgc_id, submitted_id)
+
+    @classmethod
+    def from_tsv(cls, project_id, samples_tsv):
+        """ Build the index from the TSV returned by the project samples endpoint
+
+            Args:
+                project_id (str):   An ICGC project code
+                samples_tsv (str):  The project samples TSV
+
+            Returns:
+                ProjectSampleIndex: The index of the project samples
+        """
+        lines = samples_tsv.split('\n')
+        return cls(project_id, lines[0].rstrip('\r').split('\t'),
+                   [line.rstrip('\r').split('\t') for line in lines[1:] if line.strip()])
+
+    @classmethod
+    def load(cls, index_file):
+        """ Load an index saved with save
+
+            Args:
+                index_file (str):   Path of the saved index
+
+            Returns:
+                ProjectSampleIndex: The loaded index
+        """
+        with open(index_file, 'r') as f:
+            data = json.load(f)
+        return cls(data['project_id'], data['columns'], data['rows'])
+
+    def save(self, index_file):
+        """ Save the index to a JSON file
+
+            Args:
+                index_file (str):   Path of the file
+        """
+        file_utils.write_json(index_file, {'project_id': self.project_id, 'columns': self.columns, 'rows': self.rows})
+
+    def donor_id(self, submitted_donor_id):
+        return self._ids['donor'].get(submitted_donor_id)
+
+    def specimen_id(self, submitted_specimen_id):
+        return self._ids['specimen'].get(submitted_specimen_id)
+
+    def sample_id(self, submitted_sample_id):
+        return self._ids['sample'].get(submitted_sample_id)
+
+    def submitted_donor_id(self, donor_id):
+        return self._submitted_ids['donor'].get(donor_id)
+
+    def submitted_specimen_id(self, specimen_id):
+        return self._submitted_ids['specimen'].get(specimen_id)
+
+    def submitted_sample_id(self, sample_id):
+        return self._submitted_ids['sample'].get(sample_id)
+
+    def donor_row(self, donor_id):
+        """ The first sample row of a donor
+
+            Args:
+                donor_id (str): An ICGC donor id
+
+            Returns:
+                dict:   The values of the row by column name, None if the donor is not in the project
+        """
+        return self._donor_rows.get(donor_id)
+
 def index_donors():
-    return requests.get(ICGC_API_BASEURL+'/v1/donors').text
+    return http_utils.get(ICGC_API_BASEURL+'/v1/donors').text
 
 def donors_pql():
-    return requests.get(ICGC_API_BASEURL+'/v1/donors/pql').text
+    return http_utils.get(ICGC_API_BASEURL+'/v1/donors/pql').text
 
 def get_donor(donor_id):
-    return json.loads(requests.get(ICGC_API_BASEURL+'/v1/donors/'+donor_id).text)
+    return json.loads(http_utils.get(ICGC_API_BASEURL+'/v1/donors/'+donor_id).text)
 
 def get_donor_genes(donor_id):
-    return requests.get(ICGC_API_BASEURL+'/v1/donors/'+donor_id+'/genes').text
+    return http_utils.get(ICGC_API_BASEURL+'/v1/donors/'+donor_id+'/genes').text
 
 def get_donor_genes_count(donor_id):
-    return requests.get(ICGC_API_BASEURL+'/v1/donors/'+donor_id+'/genes/count').text
+    return http_utils.get(ICGC_API_BASEURL+'/v1/donors/'+donor_id+'/genes/count').text
 
 def get_donor_genes_counts(donor_id):
-    return requests.get(ICGC_API_BASEURL+'/v1/donors/'+donor_id+'/genes/counts').text
+    return http_utils.get(ICGC_API_BASEURL+'/v1/donors/'+donor_id+'/genes/counts').text
 
 def get_donor_mutations_count_by_gene(donor_id, gene_id):
-    return requests.get(ICGC_API_BASEURL+'/v1/donors/'+donor_id+'/genes/'+gene_id+'/mutations/count').text
+    return http_utils.get(ICGC_API_BASEURL+'/v1/donors/'+donor_id+'/genes/'+gene_id+'/mutations/count').text
 
 def get_donor_mutations_counts_by_gene(donor_id, gene_id):
-    return requests.get(ICGC_API_BASEURL+'/v1/donors/'+donor_id+'/genes/'+gene_id+'/mutations/counts').text
+    return http_utils.get(ICGC_API_BASEURL+'/v1/donors/'+donor_id+'/genes/'+gene_id+'/mutations/counts').text
 
 def get_donor_mutations(donor_id):
-    return requests.get(ICGC_API_BASEURL+'/v1/donors/'+donor_id+'/mutations').text
+    return http_utils.get(ICGC_API_BASEURL+'/v1/donors/'+donor_id+'/mutations').text
 
 def get_donor_mutations_count(donor_id):
-    return requests.get(ICGC_API_BASEURL+'/v1/donors/'+donor_id+'/mutations/count').text
+    return http_utils.get(ICGC_API_BASEURL+'/v1/donors/'+donor_id+'/mutations/count').text
 
 def get_donor_mutations_counts(donor_id):
-    return requests.get(ICGC_API_BASEURL+'/v1/donors/'+donor_id+'/mutations/counts').text
+    return http_utils.get(ICGC_API_BASEURL+'/v1/donors/'+donor_id+'/mutations/counts').text
+
+def iter_donors(filters=None, size=PORTAL_PAGE_SIZE, prefetch=False):
+    """ Iterate over the donors of the portal, following its pagination
+
+        Only one page of donors is held in memory at a time.
+
+        Args:
+            filters (dict):     Portal filters ({'donor': {'primarySite': {'is': ['Brain']}}})
+            size (int):         Number of donors requested per page
+            prefetch (bool):    True to download the next page while the current one is consumed
+
+        Returns:
+            generator:  The donors, one at a time
+    """
+    return _iter_hits('/v1/donors', filters, size, prefetch)
+
+def iter_donor_genes(donor_id, filters=None, size=PORTAL_PAGE_SIZE, prefetch=False):
+    """ Iterate over the genes affected in a donor, following the portal pagination
+
+        Args:
+            donor_id (str):     An ICGC donor id
+            filters (dict):     Portal filters
+            size (int):         Number of genes requested per page
+            prefetch (bool):    True to download the next page while the current one is consumed
+
+        Returns:
+            generator:  The genes, one at a time
+    """
+    return _iter_hits('/v1/donors/'+donor_id+'/genes', filters, size, prefetch)
+
+def iter_donor_mutations(donor_id, filters=None, size=PORTAL_PAGE_SIZE, prefetch=False):
+    """ Iterate over the mutations of a donor, following the portal pagination
+
+        Args:
+            donor_id (str):     An ICGC donor id
+            filters (dict):     Portal filters
+            size (int):         Number of mutations requested per page
+            prefetch (bool):    True to download the next page while the current one is consumed
+
+        Returns:
+            generator:  The mutations, one at a time
+    """
+    return _iter_hits('/v1/donors/'+donor_id+'/mutations', filters, size, prefetch)
 
 def get_donor_genes_count_by_mutation(donor_id, mutation_id):
-    return requests.get(ICGC_API_BASEURL+'/v1/donors/'+donor_id+'/mutations/'+mutation_id+'/genes/count').text
+    return http_utils.get(ICGC_API_BASEURL+'/v1/donors/'+donor_id+'/mutations/'+mutation_id+'/genes/count').text
 
 def get_donor_genes_counts_by_mutation(donor_id, mutation_id):
-    return requests.get(ICGC_API_BASEURL+'/v1/donors/'+donor_id+'/mutations/'+mutation_id+'/genes/counts').text
+    return http_utils.get(ICGC_API_BASEURL+'/v1/donors/'+donor_id+'/mutations/'+mutation_id+'/genes/counts').text
 
 def get_donor_id_from_submitted_donor_id(project_id, submitted_donor_id):
-    for line in get_samples_from_project(project_id).split('\n'):
-        if line.split('\t')[5] == submitted_donor_id:
-            return line.split('\t')[4]
+    return get_project_samples(project_id).donor_id(submitted_donor_id)
 
 def get_gender_from_donor_id(donor_id):
-    return get_donor(donor_id).get('gender')
+    return _get_cached_donor(donor_id).get('gender')
 
 def get_submitter_donor_id_from_donor_id(donor_id):
-    return get_donor(donor_id).get('submittedDonorId')
+    return _get_cached_donor(donor_id).get('submittedDonorId')
 
 def get_samples_from_project(project_id):
-    return requests.get(ICGC_API_BASEURL+'/v1/projects/'+project_id+'/samples').text
+    return http_utils.get(ICGC_API_BASEURL+'/v1/projects/'+project_id+'/samples').text
+
+def get_project_samples(project_id):
+    """ Index of the samples of a project, downloaded once and kept in the project samples cache
+
+        Args:
+            project_id (str):   An ICGC project code
+
+        Returns:
+            ProjectSampleIndex: The index of the project samples
+    """
+    return _project_samples_cache.get_or_set(project_id, lambda: ProjectSampleIndex.from_tsv(project_id, get_samples_from_project(project_id)))
+
+def load_project_samples(index_file):
+    """ Load a project samples index saved with ProjectSampleIndex.save into the project samples cache
+
+        Args:
+            index_file (str):   Path of the saved index
+
+        Returns:
+            ProjectSampleIndex: The loaded index
+    """
+    index = ProjectSampleIndex.load(index_file)
+    _project_samples_cache.set(index.project_id, index)
+    return index
+
+def clear_cache():
+    """ Empty the project samples and donor caches
+    """
+    _project_samples_cache.clear()
+    _donor_cache.clear()
 
 def get_project_id_from_donor_id(donor_id):
-    return get_donor(donor_id).get('projectId')
+    return _get_cached_donor(donor_id).get('projectId')
 
 def get_submitted_sample_id_from_donor_id(donor_id):
     return _get_donor_dict(donor_id).get('submitted_sample_id')
@@ -92,10 +281,10 @@ def get_specimen_type_from_donor_id(donor_id):
     return _get_donor_dict(donor_id).get('specimen_type')
 
 def get_specimen_class_from_donor_id(donor_id):
-    specimen_type = get_specimen_type_from_donor_id(donor_id)
-    if "normal" in specimen_type.lower(): return "Normal"
-    if "tumour" in specimen_type.lower(): return "Tumour"
-    raise ValueError("The specimen class could not be determined")
+    specimen_class = _get_specimen_class(get_specimen_type_from_donor_id(donor_id))
+    if specimen_class is None:
+        raise ValueError("The specimen class could not be determined")
+    return specimen_class
 
 def get_sample_submitter_id_from_donor_id(donor_id):
     return _get_donor_dict(donor_id).get('icgc_sample_id')
@@ -103,28 +292,216 @@ def get_sample_submitter_id_from_donor_id(donor_id):
 def get_library_strategy_from_donor_id(donor_id):
     return _get_donor_dict(donor_id).get('sequencing_strategy')
 
+def resolve_donors(donor_ids, fields=None):
+    """ Resolve the metadata of many donors at once
+
+        Donors are looked up with one portal search per DONOR_SEARCH_PAGE_SIZE donors and the samples
+        listing of each of their projects is downloaded once, whatever the number of donors and fields.
+
+        Args:
+            donor_ids (list):   ICGC donor ids (DO...)
+            fields (list):      Fields to resolve among DONOR_FIELDS, all of them by default
+
+        Returns:
+            dict:   The resolved fields of each donor id, None for the donors that do not exist
+
+        Raises:
+            ValueError: A requested field is not supported
+    """
+    fields = DONOR_FIELDS if fields is None else list(fields)
+    for field in fields:
+        if not field in DONOR_FIELDS:
+            raise ValueError("Unsupported donor field: %s. Supported fields: %s" % (field, ', '.join(DONOR_FIELDS)))
+
+    donors = _get_cached_donors(donor_ids)
+    projects = {}
+    for donor in donors.values():
+        if not donor.get('projectId') in projects:
+            projects[donor.get('projectId')] = get_project_samples(donor.get('projectId'))
+
+    resolved = {}
+    for donor_id in donor_ids:
+        donor = donors.get(donor_id)
+        if donor is None:
+            resolved[donor_id] = None
+            continue
+        row = projects[donor.get('projectId')].donor_row(donor_id) or {}
+        values = {
+            'project_id': donor.get('projectId'),
+            'gender': donor.get('gender'),
+            'submitted_donor_id': donor.get('submittedDonorId'),
+            'icgc_sample_id': row.get('icgc_sample_id'),
+            'submitted_sample_id': row.get('submitted_sample_id'),
+            'submitted_specimen_id': row.get('submitted_specimen_id'),
+            'specimen_type': row.get('specimen_type'),
+            'specimen_class': _get_specimen_class(row.get('specimen_type')),
+            'library_strategy': row.get('sequencing_strategy')
+        }
+        resolved[donor_id] = dict((field, values[field]) for field in fields)
+    return resolved
+
 def _get_donor_dict(donor_id):
     project_id = get_project_id_from_donor_id(donor_id)
-    _keys = get_samples_from_project(project_id).split('\n')[0].split('\t')
-    for line in get_samples_from_project(project_id).split('\n'):
-        if line.split('\t')[4] == donor_id:
-            _line = line.split('\t')
-            return dict(zip(_keys,_line))
+    return get_project_samples(project_id).donor_row(donor_id)
+
+def _get_cached_donor(donor_id):
+    return _donor_cache.get_or_set(donor_id, lambda: get_donor(donor_id))
+
+def _get_cached_donors(donor_ids):
+    """ Retrieve many donors from the donor cache, searching the portal for the missing ones
+
+        Args:
+            donor_ids (list):   ICGC donor ids
+
+        Returns:
+            dict:   The donors found, by donor id
+    """
+    donors = {}
+    missing = []
+    for donor_id in set(donor_ids):
+        donor = _donor_cache.get(donor_id)
+        if donor is None:
+            missing.append(donor_id)
+        else:
+            donors[donor_id] = donor
+
+    for i in range(0, len(missing), DONOR_SEARCH_PAGE_SIZE):
+        chunk = missing[i:i+DONOR_SEARCH_PAGE_SIZE]
+        for donor in iter_donors({'donor': {'id': {'is': chunk}}}, size=len(chunk)):
+            _donor_cache.set(donor.get('id'), donor)
+            donors[donor.get('id')] = donor
+    return donors
+
+def _iter_hits(path, filters, size, prefetch):
+    """ Iterate over the hits of a paginated portal endpoint
+
+        The portal pages are requested with its from (1-based) and size parameters until
+        a short page or the total number of hits is reached.
+    """
+    params = {'size': size}
+    if filters is not None:
+        params['filters'] = filters if isinstance(filters, str) else json.dumps(filters)
+
+    pool = ThreadPool(1) if prefetch else None
+    try:
+        _from = 1
+        page = _get_page(path, params, _from)
+        while True:
+            hits = page.get('hits', [])
+            _from += len(hits)
+            has_next = len(hits) == size and _from <= page.get('pagination', {}).get('total', 0)
+            if has_next and pool:
+                next_page = pool.apply_async(_get_page, (path, params, _from))
+            page = None
+
+            for hit in hits:
+                yield hit
+
+            if not has_next:
+                return
+            page = next_page.get() if pool else _get_page(path, params, _from)
+    finally:
+        if pool:
+            pool.terminate()
+
+def _get_page(path, params, _from):
+    params = dict(params, **{'from': _from})
+    return json.loads(http_utils.get(ICGC_API_BASEURL+path, params=params).text)
+
+def _get_specimen_class(specimen_type):
+    if specimen_type is None: return None
+    if "normal" in specimen_type.lower(): return "Normal"
+    if "tumour" in specimen_type.lower(): return "Tumour"
+    return None
 
-def id_service(icgc_token, type_, project_code, submitter_id, create=True, is_test=False):
+def id_service(icgc_token, type_, project_code, submitter_id, create=True, is_test=False, base_url=None):
     """
     ICGC ID Service
     """
+    url = base_url or (ICGC_ID_SERVICE_URL_TEST if is_test else ICGC_ID_SERVICE_URL_PROD)
+    return _id_service_request(url, icgc_token, type_, project_code, submitter_id, create)
+
+def id_service_batch(icgc_token, entries, max_workers=ID_SERVICE_BATCH_WORKERS, create=True, is_test=False, cache_file=None, base_url=None):
+    """ Look up or create many ICGC ids concurrently
+
+        Identical entries are requested once and the ids already resolved are read from the
+        cache file instead of calling the ID service, the mapping of an entity to its id never changes.
+        Requests share the keep-alive connections of http_utils, whose pool size per host should be
+        at least max_workers.
+
+        Args:
+            icgc_token (str):   A valid ICGC token
+            entries (list):     Tuples (type_, project_code, submitter_id), type_ being donor, specimen or sample
+            max_workers (int):  Number of concurrent requests to the ID service
+            create (bool):      True to create the ids that do not exist yet
+            is_test (bool):     True to call the test ID service
+            cache_file (str):   A JSON file persisting the resolved ids between runs
+            base_url (str):     The ID service URL, overrides is_test
+
+        Returns:
+            list:   The ids, in the order of the entries
+
+        Raises:
+            Exception:  The ID service failed for at least one entry. The ids resolved are still cached
+    """
+    url = base_url or (ICGC_ID_SERVICE_URL_TEST if is_test else ICGC_ID_SERVICE_URL_PROD)
+    keys = [(str(type_), str(project_code), str(submitter_id)) for type_, project_code, submitter_id in entries]
+    for key in keys:
+        if not key[0] in ('donor', 'specimen', 'sample'):
+            raise Exception('Unsupported entity type: %s' % key[0])
+
+    cache = _load_id_cache(cache_file)
+    pending = [key for key in set(keys) if not _id_cache_key(url, key) in cache]
+
+    def _request(key):
+        try:
+            return _id_service_request(url, icgc_token, key[0], key[1], key[2], create), None
+        except Exception as err:
+            return None, err
+
+    pool = ThreadPool(max(1, min(max_workers, len(pending))))
+    try:
+        results = pool.map(_request, pending)
+    finally:
+        pool.close()
+        pool.join()
+
+    resolved = dict((key, cache.get(_id_cache_key(url, key))) for key in set(keys))
+    errors = []
+    for key, (_id, err) in zip(pending, results):
+        if err is not None:
+            errors.append(err)
+            continue
+        resolved[key] = _id
+        if _id:
+            cache[_id_cache_key(url, key)] = _id
+
+    if cache_file:
+        _save_id_cache(cache_file, cache)
 
+    if errors:
+        raise Exception("Failed calling ICGC ID service for %d of %d entries. First error: %s" % (len(errors), len(pending), errors[0]))
+
+    return [resolved[key] for key in keys]
+
+def _id_service_request(url, icgc_token, type_, project_code, submitter_id, create):
+    full_url = _id_service_url(url, type_, project_code, submitter_id, create)
+
+    try:
+        r = http_utils.get(full_url, headers=_id_service_headers(icgc_token))
+    except:
+        raise Exception("Failed calling ICGC ID service with: %s" % full_url)
+
+    return _check_id_service_response(full_url, r.text)
+
+def _id_service_url(url, type_, project_code, submitter_id, create):
     if not type_ in ('donor', 'specimen', 'sample'):
         raise Exception('Unsupported entity type: %s' % type_)
 
     project_code = str(project_code)
     submitter_id = str(submitter_id)
 
-    url = ICGC_ID_SERVICE_URL_TEST if is_test else ICGC_ID_SERVICE_URL_PROD
     path = ICGC_ID_SERVICE_ENDPOINTS['id'][type_]['path']
-
     project_param = '='.join([
                                 ICGC_ID_SERVICE_ENDPOINTS['id'][type_]['params'][0],
                                 project_code
@@ -135,21 +512,33 @@ def id_service(icgc_token, type_, project_code, submitter_id, create=True, is_te
                                 ])
     create_param = '='.join(['create', 'true' if create else 'false'])
 
-    try:
-        full_url = "%s/%s?%s&%s&%s" % (url, path, project_param, submitter_id_param, create_param)
-
-        r = requests.get(full_url,
-                       headers={
-                                'Content-Type': 'application/json',
-                                'Authorization': 'Bearer %s' % icgc_token
-                                }
-                    )
-    except:
-        raise Exception("Failed calling ICGC ID service with: %s" % full_url)
+    return "%s/%s?%s&%s&%s" % (url, path, project_param, submitter_id_param, create_param)
+
+def _id_service_headers(icgc_token):
+    return {
+        'Content-Type': 'application/json',
+        'Authorization': 'Bearer %s' % icgc_token
+    }
 
-    if "error" in r.text:
-        res = re.sub(r'"error_description":".*"', '"error_description":""', r.text) if 'invalid_token' in r.text else r.text
+def _check_id_service_response(full_url, text):
+    if "error" in text:
+        res = re.sub(r'"error_description":".*"', '"error_description":""', text) if 'invalid_token' in text else text
         raise Exception("Failed calling ICGC ID serivce with: %s. Server response: %s" % (full_url, res))
 
-    return r.text
+    return text
+
+def _id_cache_key(url, key):
+    return '\t'.join((url,) + tuple(key))
 
+def _load_id_cache(cache_file):
+    if not cache_file or not os.path.isfile(cache_file):
+        return {}
+    with open(cache_file, 'r') as f:
+        return json.load(f)
+
+def _save_id_cache(cache_file, cache):
+    """ Save the ID cache, merged with the ids saved meanwhile by other processes
+    """
+    merged = _load_id_cache(cache_file)
+    merged.update(cache)
+    file_utils.write_json(cache_file, merged)
\ No newline at end of file
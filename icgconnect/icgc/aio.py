@@ -0,0 +1,162 @@
+"""
+Asyncio client for the ICGC portal and ID service
+
+Coroutine versions of the donor, project samples and ID service functions of icgconnect.icgc.
+The coroutines share one aiohttp session per event loop and a semaphore bounding the number of
+requests in flight. This module requires Python 3.5+ and aiohttp (pip install icgconnect[aio]).
+
+    import asyncio
+    from icgconnect.icgc import aio
+
+    async def main():
+        try:
+            return await asyncio.gather(*[aio.get_donor(donor_id) for donor_id in donor_ids])
+        finally:
+            await aio.close()
+"""
+
+import asyncio
+import json
+import weakref
+import aiohttp
+import icgconnect.icgc as icgc
+from icgconnect.utils import http_utils
+
+MAX_CONCURRENCY = 100 # requests in flight per event loop
+
+# State by event loop. The session of a loop references the loop, so the loops closed without calling
+# close() are dropped from the state on the next use, which lets the garbage collector release them
+_state = weakref.WeakKeyDictionary()
+
+def configure(max_concurrency=None):
+    """ Configure the async client. The new settings apply to the sessions created afterwards
+
+        Args:
+            max_concurrency (int):  Maximum number of requests in flight
+    """
+    global MAX_CONCURRENCY
+    if max_concurrency is not None:
+        MAX_CONCURRENCY = max_concurrency
+
+async def close():
+    """ Close the session of the running event loop
+    """
+    state = _state.pop(asyncio.get_event_loop(), None)
+    if state is not None:
+        await state['session'].close()
+
+async def get_donor(donor_id):
+    return json.loads(await _get_text(icgc.ICGC_API_BASEURL+'/v1/donors/'+donor_id))
+
+async def get_samples_from_project(project_id):
+    return await _get_text(icgc.ICGC_API_BASEURL+'/v1/projects/'+project_id+'/samples')
+
+async def get_project_samples(project_id):
+    """ Index of the samples of a project, shared with the project samples cache of icgconnect.icgc
+
+        Concurrent calls for the same project wait for a single download.
+
+        Args:
+            project_id (str):   An ICGC project code
+
+        Returns:
+            ProjectSampleIndex: The index of the project samples
+    """
+    samples = icgc._project_samples_cache.get(project_id)
+    if samples is not None:
+        return samples
+
+    pending = _get_state()['pending_projects']
+    if not project_id in pending:
+        pending[project_id] = asyncio.ensure_future(_download_project_samples(project_id, pending))
+    return await asyncio.shield(pending[project_id])
+
+async def id_service(icgc_token, type_, project_code, submitter_id, create=True, is_test=False, base_url=None):
+    """
+    ICGC ID Service
+    """
+    url = base_url or (icgc.ICGC_ID_SERVICE_URL_TEST if is_test else icgc.ICGC_ID_SERVICE_URL_PROD)
+    full_url = icgc._id_service_url(url, type_, project_code, submitter_id, create)
+
+    try:
+        text = await _get_text(full_url, headers=icgc._id_service_headers(icgc_token))
+    except (aiohttp.ClientError, asyncio.TimeoutError):
+        raise Exception("Failed calling ICGC ID service with: %s" % full_url)
+
+    return icgc._check_id_service_response(full_url, text)
+
+async def id_service_batch(icgc_token, entries, create=True, is_test=False, cache_file=None, base_url=None):
+    """ Look up or create many ICGC ids concurrently
+
+        Same behaviour as icgconnect.icgc.id_service_batch, the concurrency being bounded by MAX_CONCURRENCY.
+
+        Args:
+            icgc_token (str):   A valid ICGC token
+            entries (list):     Tuples (type_, project_code, submitter_id), type_ being donor, specimen or sample
+            create (bool):      True to create the ids that do not exist yet
+            is_test (bool):     True to call the test ID service
+            cache_file (str):   A JSON file persisting the resolved ids between runs
+            base_url (str):     The ID service URL, overrides is_test
+
+        Returns:
+            list:   The ids, in the order of the entries
+    """
+    url = base_url or (icgc.ICGC_ID_SERVICE_URL_TEST if is_test else icgc.ICGC_ID_SERVICE_URL_PROD)
+    keys = [(str(type_), str(project_code), str(submitter_id)) for type_, project_code, submitter_id in entries]
+    for key in keys:
+        if not key[0] in ('donor', 'specimen', 'sample'):
+            raise Exception('Unsupported entity type: %s' % key[0])
+
+    cache = icgc._load_id_cache(cache_file)
+    pending = [key for key in set(keys) if not icgc._id_cache_key(url, key) in cache]
+    results = await asyncio.gather(*[id_service(icgc_token, key[0], key[1], key[2], create, base_url=url) for key in pending],
+                                   return_exceptions=True)
+
+    resolved = dict((key, cache.get(icgc._id_cache_key(url, key))) for key in set(keys))
+    errors = []
+    for key, result in zip(pending, results):
+        if isinstance(result, Exception):
+            errors.append(result)
+            continue
+        resolved[key] = result
+        if result:
+            cache[icgc._id_cache_key(url, key)] = result
+
+    if cache_file:
+        icgc._save_id_cache(cache_file, cache)
+
+    if errors:
+        raise Exception("Failed calling ICGC ID service for %d of %d entries. First error: %s" % (len(errors), len(pending), errors[0]))
+
+    return [resolved[key] for key in keys]
+
+async def _download_project_samples(project_id, pending):
+    try:
+        samples = icgc.ProjectSampleIndex.from_tsv(project_id, await get_samples_from_project(project_id))
+        icgc._project_samples_cache.set(project_id, samples)
+        return samples
+    finally:
+        pending.pop(project_id, None)
+
+async def _get_text(url, params=None, headers=None):
+    state = _get_state()
+    async with state['semaphore']:
+        async with state['session'].get(url, params=params, headers=headers) as r:
+            return await r.text()
+
+def _get_state():
+    """ The session, semaphore and pending downloads of the running event loop, created on first use
+    """
+    loop = asyncio.get_event_loop()
+    for closed_loop in [other for other in list(_state.keys()) if other.is_closed()]:
+        _state.pop(closed_loop, None)
+    if not loop in _state:
+        connect_timeout, read_timeout = http_utils.DEFAULT_TIMEOUT
+        _state[loop] = {
+            'session': aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=MAX_CONCURRENCY),
+                timeout=aiohttp.ClientTimeout(connect=connect_timeout, sock_read=read_timeout)),
+            'semaphore': asyncio.Semaphore(MAX_CONCURRENCY),
+            'pending_projects': {}
+        }
+    return _state[loop]
@@ -1,9 +1,91 @@
-import urllib, json, jsonschema
+import json, os, threading
+from multiprocessing import Pool, cpu_count
+from icgconnect.utils import http_utils
+
+SCHEMA_URL = "https://raw.githubusercontent.com/overture-stack/SONG/develop/song-server/src/main/resources/schemas/sequencingRead.json"
+SCHEMA_FILE = os.environ.get('ICGCONNECT_SONG_SCHEMA_FILE') # a local schema used instead of SCHEMA_URL
+
+_schema = None
+_validator = None
+_lock = threading.RLock()
 
 def get_schema():
-    url = "https://raw.githubusercontent.com/overture-stack/SONG/develop/song-server/src/main/resources/schemas/sequencingRead.json"
-    response = urllib.urlopen(url)
-    return  json.loads(response.read())
+    """ The SONG sequencingRead schema, downloaded once or read from the pinned schema file
+
+        Returns:
+            dict:   The JSON schema
+    """
+    global _schema
+    with _lock:
+        if _schema is None:
+            if SCHEMA_FILE:
+                with open(SCHEMA_FILE, 'r') as f:
+                    _schema = json.load(f)
+            else:
+                _schema = json.loads(http_utils.get(SCHEMA_URL).text)
+        return _schema
+
+def pin_schema(schema_file):
+    """ Validate against a local copy of the schema instead of downloading it
+
+        Args:
+            schema_file (str):  Path of the JSON schema, None to download it again from SCHEMA_URL
+    """
+    global SCHEMA_FILE, _schema, _validator
+    with _lock:
+        SCHEMA_FILE = schema_file
+        _schema = None
+        _validator = None
+
+def get_validator():
+    """ The validator of the SONG schema, compiled once
+
+        Returns:
+            The jsonschema validator
+    """
+    global _validator
+    with _lock:
+        if _validator is None:
+            import jsonschema
+            schema = get_schema()
+            cls = jsonschema.validators.validator_for(schema)
+            cls.check_schema(schema)
+            _validator = cls(schema)
+        return _validator
 
 def validate_schema(json_text):
-    jsonschema.validate(json_text, get_schema())
+    get_validator().validate(json_text)
+
+def validate_many(docs, workers=None):
+    """ Validate many SONG payloads on a process pool
+
+        Args:
+            docs (list):    The payloads to validate
+            workers (int):  Number of processes, the number of CPUs by default. 1 validates in the current process
+
+        Returns:
+            list:   The error messages of each payload, in the order of the payloads. Valid payloads have no error
+    """
+    docs = list(docs)
+    if workers == 1:
+        return [_get_errors(doc) for doc in docs]
+
+    pool = Pool(workers, initializer=_init_worker, initargs=(get_schema(),))
+    try:
+        return pool.map(_get_errors, docs, chunksize=max(1, len(docs) // ((workers or cpu_count()) * 4)))
+    finally:
+        pool.close()
+        pool.join()
+
+def _init_worker(schema):
+    global _schema, _validator
+    _schema = schema
+    _validator = None
+    get_validator()
+
+def _get_errors(doc):
+    errors = []
+    for error in get_validator().iter_errors(doc):
+        path = '/'.join(str(p) for p in error.path)
+        errors.append(path+': '+error.message if path else error.message)
+    return errors
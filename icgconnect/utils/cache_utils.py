@@ -0,0 +1,218 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from icgconnect.utils import file_utils
+
+DISK_CACHE_SCAN_WRITES = 1000 # writes between two scans of a disk cache directory shared by processes
+DISK_CACHE_EVICTION_TARGET = 0.9 # fraction of the maximum size of a disk cache left after an eviction
+
+class LRUCache(object):
+	""" A thread-safe in-memory cache with a least recently used eviction policy
+
+		Entries older than the time to live are discarded when they are accessed.
+
+		Args:
+			max_size (int):	Maximum number of entries kept in the cache
+			ttl (float):	Time to live of an entry in seconds, None to never expire
+	"""
+
+	def __init__(self, max_size=128, ttl=None):
+		if max_size < 1:
+			raise ValueError("The cache size must be greater than 0: "+str(max_size))
+		self.max_size = max_size
+		self.ttl = ttl
+		self._entries = OrderedDict()
+		self._lock = threading.Lock()
+
+	def get(self, key, default=None):
+		""" Retrieve an entry and mark it as the most recently used
+
+			Args:
+				key:		The key of the entry
+				default:	The value returned if the key is missing or expired
+
+			Returns:
+				The cached value
+		"""
+		with self._lock:
+			if not key in self._entries:
+				return default
+			timestamp, value = self._entries.pop(key)
+			if self.ttl is not None and time.time() - timestamp > self.ttl:
+				return default
+			self._entries[key] = (timestamp, value)
+			return value
+
+	def set(self, key, value):
+		""" Add or replace an entry, evicting the least recently used entries if the cache is full
+
+			Args:
+				key:	The key of the entry
+				value:	The value to cache
+		"""
+		with self._lock:
+			self._entries.pop(key, None)
+			self._entries[key] = (time.time(), value)
+			while len(self._entries) > self.max_size:
+				self._entries.popitem(last=False)
+
+	def get_or_set(self, key, factory):
+		""" Retrieve an entry, computing and caching it if it is missing or expired
+
+			Args:
+				key:		The key of the entry
+				factory:	A function without argument returning the value to cache
+
+			Returns:
+				The cached value
+		"""
+		value = self.get(key, _MISSING)
+		if value is _MISSING:
+			value = factory()
+			self.set(key, value)
+		return value
+
+	def pop(self, key, default=None):
+		""" Remove an entry from the cache
+
+			Args:
+				key:		The key of the entry
+				default:	The value returned if the key is missing
+
+			Returns:
+				The removed value
+		"""
+		with self._lock:
+			if not key in self._entries:
+				return default
+			return self._entries.pop(key)[1]
+
+	def clear(self):
+		""" Remove all entries from the cache
+		"""
+		with self._lock:
+			self._entries.clear()
+
+	def __contains__(self, key):
+		return self.get(key, _MISSING) is not _MISSING
+
+	def __len__(self):
+		with self._lock:
+			return len(self._entries)
+
+class DiskCache(object):
+	""" A cache of binary entries with JSON metadata stored in a directory, with a size cap
+
+		Each entry is a file named after the hash of its key. Entries are written atomically so that
+		several processes can share the directory, and the least recently used entries are deleted
+		when the directory grows over its maximum size.
+
+		The size of the directory is counted by the instance instead of measured on every write. The
+		directory is scanned when the count goes over the maximum size, then the entries are deleted
+		down to a fraction of it, and every scan_writes writes to count the entries of other processes.
+
+		Args:
+			directory (str):	The cache directory, created if it does not exist
+			max_size (int):		Maximum size of the cache in bytes
+			scan_writes (int):	Number of writes between two scans of the directory
+	"""
+
+	def __init__(self, directory, max_size, scan_writes=DISK_CACHE_SCAN_WRITES):
+		if not os.path.isdir(directory):
+			os.makedirs(directory)
+		self.directory = directory
+		self.max_size = max_size
+		self.scan_writes = scan_writes
+		self._size = None
+		self._writes = 0
+		self._lock = threading.Lock()
+
+	def get(self, key):
+		""" Retrieve an entry and mark it as the most recently used
+
+			Args:
+				key (str):	The key of the entry
+
+			Returns:
+				tuple:	The metadata (dict) and the content (bytes) of the entry, None if the key is missing
+		"""
+		path = self._path(key)
+		try:
+			with open(path, 'rb') as f:
+				metadata = json.loads(f.readline().decode('utf-8'))
+				content = f.read()
+			os.utime(path, None)
+		except (IOError, OSError, ValueError):
+			return None
+		return metadata, content
+
+	def set(self, key, metadata, content):
+		""" Add or replace an entry, evicting the least recently used entries if the cache is full
+
+			Args:
+				key (str):			The key of the entry
+				metadata (dict):	JSON serializable metadata of the entry
+				content (bytes):	The content of the entry
+		"""
+		path = self._path(key)
+		data = json.dumps(metadata).encode('utf-8')+b'\n'+content
+		try:
+			replaced_size = os.path.getsize(path)
+		except OSError:
+			replaced_size = 0
+		file_utils.write_atomic(path, data)
+		with self._lock:
+			self._writes += 1
+			if self._size is not None:
+				self._size += len(data) - replaced_size
+			if self._size is None or self._size > self.max_size or self._writes >= self.scan_writes:
+				self._evict()
+
+	def clear(self):
+		""" Remove all entries from the cache
+		"""
+		for path, _, _ in self._entries():
+			_remove(path)
+		with self._lock:
+			self._size = None
+
+	def _evict(self):
+		""" Measure the directory and delete the least recently used entries if it is over the maximum size
+		"""
+		entries = self._entries()
+		size = sum(entry[2] for entry in entries)
+		if size > self.max_size:
+			for path, _, entry_size in sorted(entries, key=lambda entry: entry[1]):
+				if size <= self.max_size * DISK_CACHE_EVICTION_TARGET:
+					break
+				_remove(path)
+				size -= entry_size
+		self._size = size
+		self._writes = 0
+
+	def _entries(self):
+		entries = []
+		for name in os.listdir(self.directory):
+			if name.startswith('.'):
+				continue
+			path = os.path.join(self.directory, name)
+			try:
+				stat = os.stat(path)
+			except OSError:
+				continue
+			entries.append((path, stat.st_mtime, stat.st_size))
+		return entries
+
+	def _path(self, key):
+		return os.path.join(self.directory, hashlib.sha1(key.encode('utf-8')).hexdigest())
+
+def _remove(path):
+	try:
+		os.remove(path)
+	except OSError:
+		pass
+
+_MISSING = object()
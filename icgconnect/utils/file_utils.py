@@ -1,7 +1,8 @@
 import hashlib
+import json
 import os
+import tempfile
 from shutil import copyfile
-import pysam
 
 def get_file_md5(fname):
 	if not os.path.isfile(fname):
@@ -28,6 +29,32 @@ def get_file_type(fname):
 	raise ValueError("The file does not have a recognized extension: "+fname)
 
 
+def write_json(fname, data):
+	""" Write a JSON file atomically, readers never see a partially written file
+
+		Args:
+			fname (str):	Path of the JSON file
+			data:			The data to serialize
+	"""
+	write_atomic(fname, json.dumps(data).encode('utf-8'))
+
+def write_atomic(fname, content):
+	""" Write a file atomically through a temporary file renamed over the destination
+
+		Args:
+			fname (str):		Path of the file
+			content (bytes):	The content of the file
+	"""
+	directory = os.path.dirname(os.path.abspath(fname))
+	fd, tmp_name = tempfile.mkstemp(dir=directory, prefix='.'+os.path.basename(fname)+'.')
+	try:
+		with os.fdopen(fd, 'wb') as f:
+			f.write(content)
+		os.rename(tmp_name, fname)
+	except:
+		os.remove(tmp_name)
+		raise
+
 def delete_file(filename):
 	""" Delete a file in the local system
 
@@ -62,6 +89,7 @@ def generate_bai_from_bam(bam_file_path, file_output):
 	if bam_file_path == file_output:
 		raise ValueError("The input file cannot be the same as the output file: "+bam_file_path)
 
+	import pysam
 	pysam.index(bam_file_path)
 	if not bam_file_path+".bai" == file_output:
 		copyfile(bam_file_path+".bai",file_output)
@@ -0,0 +1,191 @@
+"""
+Shared HTTP transport
+
+All the modules of icgconnect send their requests through one pooled requests session, so that
+connections are kept alive between calls. Requests get a default timeout and are retried with an
+exponential backoff on connection errors and 5xx responses. The session can be used from many threads.
+
+GET responses can also be kept in an on-disk cache, enabled with enable_cache or the
+ICGCONNECT_HTTP_CACHE_DIR environment variable. Cached responses are revalidated with their
+ETag or Last-Modified header, so the server only sends the data again if it changed.
+"""
+
+import hashlib
+import os
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+from requests.structures import CaseInsensitiveDict
+from icgconnect.utils import cache_utils
+
+DEFAULT_TIMEOUT = (30, 300) # connect and read timeouts in seconds
+DEFAULT_POOL_SIZE = 10 # connections kept alive per host
+POOLED_HOSTS = 20 # hosts whose connection pool is kept
+DEFAULT_RETRIES = 3
+DEFAULT_BACKOFF_FACTOR = 0.5 # retries wait 0.5s, 1s, 2s...
+RETRY_STATUSES = (500, 502, 503, 504)
+DEFAULT_CACHE_MAX_SIZE = 1024 * 1024 * 1024 # bytes
+AUTH_HEADERS = ('Authorization', 'X-Token') # headers defining the auth scope of a cached response
+
+_config = {
+	'timeout': DEFAULT_TIMEOUT,
+	'pool_size': DEFAULT_POOL_SIZE,
+	'host_pool_sizes': {},
+	'retries': DEFAULT_RETRIES,
+	'backoff_factor': DEFAULT_BACKOFF_FACTOR
+}
+_session = None
+_cache = None
+_lock = threading.Lock()
+
+def configure(timeout=None, pool_size=None, host_pool_sizes=None, retries=None, backoff_factor=None):
+	""" Configure the shared session. The session is rebuilt with the new settings on its next use
+
+		Args:
+			timeout:				Default timeout in seconds, or a (connect, read) tuple
+			pool_size (int):		Connections kept alive per host
+			host_pool_sizes (dict):	Pool sizes of specific hosts, by URL prefix (https://ega.ebi.ac.uk)
+			retries (int):			Retries on connection errors and 5xx responses, 0 to disable
+			backoff_factor (float):	Factor of the exponential backoff between retries
+	"""
+	global _session
+	with _lock:
+		for key, value in (('timeout', timeout), ('pool_size', pool_size), ('host_pool_sizes', host_pool_sizes),
+						   ('retries', retries), ('backoff_factor', backoff_factor)):
+			if value is not None:
+				_config[key] = value
+		_session = None
+
+def get_session():
+	""" The shared session, created on first use
+
+		Returns:
+			requests.Session:	The pooled session
+	"""
+	global _session
+	session = _session
+	if session is None:
+		with _lock:
+			if _session is None:
+				_session = _create_session()
+			session = _session
+	return session
+
+def enable_cache(directory, max_size=DEFAULT_CACHE_MAX_SIZE):
+	""" Keep the GET responses carrying an ETag or a Last-Modified header in an on-disk cache
+
+		The directory can be shared by several processes, for instance to warm up worker nodes.
+
+		Args:
+			directory (str):	The cache directory
+			max_size (int):		Maximum size of the cache in bytes, the least recently used responses are evicted first
+	"""
+	global _cache
+	_cache = cache_utils.DiskCache(directory, max_size)
+
+def disable_cache():
+	""" Stop using the on-disk cache. The cached responses are kept on disk
+	"""
+	global _cache
+	_cache = None
+
+def request(method, url, **kwargs):
+	""" Send a request through the shared session, with the default timeout unless one is given
+
+		Args:
+			method (str):	The HTTP method
+			url (str):		The URL to request
+			kwargs:			Any argument of requests.request
+
+		Returns:
+			requests.Response:	The server response
+	"""
+	kwargs.setdefault('timeout', _config['timeout'])
+	cache = _cache
+	if cache is not None and method.upper() == 'GET' and not kwargs.get('stream'):
+		return _cached_get(cache, url, **kwargs)
+	return get_session().request(method, url, **kwargs)
+
+def get(url, **kwargs):
+	return request('GET', url, **kwargs)
+
+def head(url, **kwargs):
+	return request('HEAD', url, **kwargs)
+
+def post(url, **kwargs):
+	return request('POST', url, **kwargs)
+
+def put(url, **kwargs):
+	return request('PUT', url, **kwargs)
+
+def delete(url, **kwargs):
+	return request('DELETE', url, **kwargs)
+
+def _create_session():
+	session = requests.Session()
+	session.mount('http://', _create_adapter(_config['pool_size']))
+	session.mount('https://', _create_adapter(_config['pool_size']))
+	for prefix, pool_size in _config['host_pool_sizes'].items():
+		session.mount(prefix, _create_adapter(pool_size))
+	return session
+
+def _create_adapter(pool_size):
+	retry = Retry(total=_config['retries'], connect=_config['retries'], read=_config['retries'],
+				  status=_config['retries'], backoff_factor=_config['backoff_factor'],
+				  status_forcelist=RETRY_STATUSES, raise_on_status=False)
+	return HTTPAdapter(pool_connections=POOLED_HOSTS, pool_maxsize=pool_size, max_retries=retry)
+
+def _cached_get(cache, url, **kwargs):
+	""" Send a GET request, revalidating the cached response if there is one
+	"""
+	headers = dict(kwargs.pop('headers', None) or {})
+	key = _cache_key(url, kwargs.get('params'), headers)
+	entry = cache.get(key)
+	if entry is not None:
+		if entry[0].get('etag'):
+			headers['If-None-Match'] = entry[0]['etag']
+		if entry[0].get('last_modified'):
+			headers['If-Modified-Since'] = entry[0]['last_modified']
+
+	r = get_session().request('GET', url, headers=headers, **kwargs)
+
+	if r.status_code == 304 and entry is not None:
+		return _cached_response(entry, r)
+
+	if r.status_code == 200 and (r.headers.get('ETag') or r.headers.get('Last-Modified')):
+		cache.set(key, {
+			'etag': r.headers.get('ETag'),
+			'last_modified': r.headers.get('Last-Modified'),
+			'encoding': r.encoding,
+			'headers': dict(r.headers)
+		}, r.content)
+	return r
+
+def _cache_key(url, params, headers):
+	""" The key of a cached response: the full URL and a hash of the credentials sent with it
+	"""
+	full_url = requests.Request('GET', url, params=params).prepare().url
+	scope = hashlib.sha1('\n'.join(str(headers.get(name, '')) for name in AUTH_HEADERS).encode('utf-8')).hexdigest()
+	return full_url+'\n'+scope
+
+def _cached_response(entry, not_modified):
+	""" Build a response from a cached entry and the 304 response revalidating it
+	"""
+	metadata, content = entry
+	r = requests.Response()
+	r.status_code = 200
+	r.reason = 'OK'
+	r.headers = CaseInsensitiveDict(metadata['headers'])
+	for name in ('Date', 'ETag', 'Last-Modified', 'Cache-Control', 'Expires'):
+		if name in not_modified.headers:
+			r.headers[name] = not_modified.headers[name]
+	r.encoding = metadata['encoding']
+	r._content = content
+	r.url = not_modified.url
+	r.request = not_modified.request
+	r.elapsed = not_modified.elapsed
+	return r
+
+if os.environ.get('ICGCONNECT_HTTP_CACHE_DIR'):
+	enable_cache(os.environ['ICGCONNECT_HTTP_CACHE_DIR'], int(os.environ.get('ICGCONNECT_HTTP_CACHE_MAX_SIZE', DEFAULT_CACHE_MAX_SIZE)))
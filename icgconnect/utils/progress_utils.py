@@ -0,0 +1,237 @@
+"""
+Progress events and metrics of the downloads
+
+A download reports its progress to a listener, any function taking an event (dict). Every event has
+the keys event, name, time, bytes, elapsed, average_throughput and retries:
+
+- progress: Sent at most every interval seconds while bytes arrive, with total and throughput (instantaneous, bytes per second)
+- segment: Sent when a byte range is downloaded, with start, end and latency (seconds)
+- finished: Sent at the end of the download, with error (None if the download succeeded)
+
+JsonLinesExporter and PrometheusExporter are listeners writing the events to a file.
+
+	download_ticket(ticket_id, output_file, progress=progress_utils.JsonLinesExporter('downloads.jsonl'))
+"""
+
+import json
+import os
+import threading
+import time
+from icgconnect.utils import file_utils
+
+PROGRESS_INTERVAL = 1.0 # minimum seconds between two progress events of a download
+WATCH_INTERVAL = 1.0 # seconds between two measures of the output directory of a download subprocess
+
+class Progress(object):
+	""" Progress of a download, reported to a listener
+
+		Args:
+			name (str):			Name of the download in the events, e.g. the output file
+			listener:			A function taking an event (dict), None to only count the bytes
+			total (int):		Number of bytes to download, None if unknown
+			interval (float):	Minimum seconds between two progress events
+	"""
+
+	def __init__(self, name, listener=None, total=None, interval=PROGRESS_INTERVAL):
+		self.name = name
+		self.listener = listener
+		self.total = total
+		self.interval = interval
+		self.bytes = 0
+		self.retries = 0
+		self._start = time.time()
+		self._last_time = self._start
+		self._last_bytes = 0
+		self._lock = threading.Lock()
+
+	def add(self, size):
+		""" Record bytes received
+		"""
+		with self._lock:
+			self.bytes += size
+			now = time.time()
+			if self.listener is None or now <= self._last_time or now - self._last_time < self.interval:
+				return
+			event = self._event('progress', now, total=self.total, throughput=(self.bytes - self._last_bytes) / (now - self._last_time))
+			self._last_time = now
+			self._last_bytes = self.bytes
+		self.listener(event)
+
+	def segment(self, start, end, latency, retries=0):
+		""" Record a byte range downloaded
+
+			Args:
+				start (int):		The first byte of the range
+				end (int):			The last byte of the range
+				latency (float):	Seconds taken to download the range
+				retries (int):		Number of retried requests of the range
+		"""
+		with self._lock:
+			self.retries += retries
+			event = self._event('segment', time.time(), start=start, end=end, latency=latency)
+		if self.listener is not None:
+			self.listener(event)
+
+	def retry(self, count=1):
+		""" Record retried requests
+		"""
+		with self._lock:
+			self.retries += count
+
+	def finish(self, error=None):
+		""" Record the end of the download
+
+			Args:
+				error (str):	The error that stopped the download, None if it succeeded
+		"""
+		with self._lock:
+			event = self._event('finished', time.time(), total=self.total, error=error)
+		if self.listener is not None:
+			self.listener(event)
+
+	def _event(self, name, now, **values):
+		elapsed = now - self._start
+		event = {
+			'event': name,
+			'name': self.name,
+			'time': now,
+			'bytes': self.bytes,
+			'elapsed': elapsed,
+			'average_throughput': self.bytes / elapsed if elapsed > 0 else 0,
+			'retries': self.retries
+		}
+		event.update(values)
+		return event
+
+class JsonLinesExporter(object):
+	""" A listener appending the events to a file, one JSON object per line
+
+		Args:
+			path (str):	Path of the file
+	"""
+
+	def __init__(self, path):
+		self.path = path
+		self._lock = threading.Lock()
+
+	def __call__(self, event):
+		line = json.dumps(event, sort_keys=True)+'\n'
+		with self._lock:
+			with open(self.path, 'a') as f:
+				f.write(line)
+
+class PrometheusExporter(object):
+	""" A listener writing the metrics of the downloads in the Prometheus textfile format
+
+		The file is rewritten atomically for the textfile collector of the node exporter, at most every
+		interval seconds and when a download finishes. The metrics of a finished download are added to
+		totals without a name label, so that the file only lists the running downloads.
+
+		Args:
+			path (str):			Path of the .prom file
+			prefix (str):		Prefix of the metric names
+			interval (float):	Minimum seconds between two writes of the file, except for finished downloads
+	"""
+
+	METRICS = [
+		('bytes_total', 'counter', 'Bytes downloaded'),
+		('throughput_bytes_per_second', 'gauge', 'Instantaneous throughput of the download'),
+		('average_throughput_bytes_per_second', 'gauge', 'Average throughput of the download'),
+		('retries_total', 'counter', 'Retried requests'),
+		('segment_latency_seconds_sum', 'counter', 'Total time spent downloading byte ranges'),
+		('segment_latency_seconds_count', 'counter', 'Byte ranges downloaded')
+	]
+
+	FINISHED_METRICS = [
+		('succeeded_total', 'counter', 'Downloads finished successfully'),
+		('failed_total', 'counter', 'Downloads finished with an error'),
+		('finished_bytes_total', 'counter', 'Bytes downloaded by the finished downloads'),
+		('finished_retries_total', 'counter', 'Retried requests of the finished downloads'),
+		('finished_segment_latency_seconds_sum', 'counter', 'Total time spent downloading byte ranges by the finished downloads'),
+		('finished_segment_latency_seconds_count', 'counter', 'Byte ranges downloaded by the finished downloads')
+	]
+
+	def __init__(self, path, prefix='icgconnect_download', interval=PROGRESS_INTERVAL):
+		self.path = path
+		self.prefix = prefix
+		self.interval = interval
+		self._downloads = {}
+		self._finished = dict((metric[0], 0) for metric in self.FINISHED_METRICS)
+		self._last_write = None
+		self._lock = threading.Lock()
+
+	def __call__(self, event):
+		with self._lock:
+			metrics = self._downloads.setdefault(event['name'], dict((metric[0], 0) for metric in self.METRICS))
+			metrics['bytes_total'] = event['bytes']
+			metrics['average_throughput_bytes_per_second'] = event['average_throughput']
+			metrics['retries_total'] = event['retries']
+			if event['event'] == 'progress':
+				metrics['throughput_bytes_per_second'] = event['throughput']
+			elif event['event'] == 'segment':
+				metrics['segment_latency_seconds_sum'] += event['latency']
+				metrics['segment_latency_seconds_count'] += 1
+			elif event['event'] == 'finished':
+				del self._downloads[event['name']]
+				self._finished['succeeded_total' if event.get('error') is None else 'failed_total'] += 1
+				self._finished['finished_bytes_total'] += metrics['bytes_total']
+				self._finished['finished_retries_total'] += metrics['retries_total']
+				self._finished['finished_segment_latency_seconds_sum'] += metrics['segment_latency_seconds_sum']
+				self._finished['finished_segment_latency_seconds_count'] += metrics['segment_latency_seconds_count']
+
+			now = time.time()
+			if event['event'] != 'finished' and self._last_write is not None and 0 <= now - self._last_write < self.interval:
+				return
+			self._last_write = now
+			file_utils.write_atomic(self.path, self._format().encode('utf-8'))
+
+	def _format(self):
+		lines = []
+		for metric, metric_type, description in self.METRICS:
+			name = self.prefix+'_'+metric
+			lines.append('# HELP '+name+' '+description)
+			lines.append('# TYPE '+name+' '+metric_type)
+			for download, metrics in sorted(self._downloads.items()):
+				lines.append('%s{name="%s"} %s' % (name, download.replace('\\', '\\\\').replace('"', '\\"'), repr(float(metrics[metric]))))
+		for metric, metric_type, description in self.FINISHED_METRICS:
+			name = self.prefix+'_'+metric
+			lines.append('# HELP '+name+' '+description)
+			lines.append('# TYPE '+name+' '+metric_type)
+			lines.append('%s %s' % (name, repr(float(self._finished[metric]))))
+		return '\n'.join(lines)+'\n'
+
+def watch(process, directory, name, listener, interval=WATCH_INTERVAL):
+	""" Report the progress of a download subprocess by measuring the size of its output directory
+
+		Args:
+			process (subprocess.Popen):	The running download
+			directory (str):			The output directory of the download
+			name (str):					Name of the download in the events
+			listener:					A function taking an event (dict)
+			interval (float):			Seconds between two measures of the directory
+
+		Returns:
+			int:	The return code of the process
+	"""
+	progress = Progress(name, listener, interval=0)
+	initial_size = _directory_size(directory)
+	while process.poll() is None:
+		time.sleep(interval)
+		size = _directory_size(directory) - initial_size
+		if size > progress.bytes:
+			progress.add(size - progress.bytes)
+	size = _directory_size(directory) - initial_size
+	if size > progress.bytes:
+		progress.bytes = size
+	progress.finish(None if process.returncode == 0 else "Download exited with status "+str(process.returncode))
+	return process.returncode
+
+def _directory_size(directory):
+	size = 0
+	for root, _, files in os.walk(directory):
+		for name in files:
+			try:
+				size += os.path.getsize(os.path.join(root, name))
+			except OSError:
+				pass
+	return size
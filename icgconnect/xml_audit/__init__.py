@@ -1,8 +1,7 @@
 from xml.dom import minidom
 import os
 import sys
-import urllib
-import requests
+from icgconnect.utils import http_utils
 
 
 def get_dataset(project_folder, project_name, dataset_accession):
@@ -219,7 +218,7 @@ def _get_obj_xml(file_path, tag_name,root_name):
 	reload(sys)
 	sys.setdefaultencoding('utf-8')
 	print(file_path)
-	elem =  minidom.parseString(minidom.parse(urllib.urlopen(file_path)).getElementsByTagName(tag_name)[0].toxml()).firstChild
+	elem =  minidom.parseString(minidom.parseString(http_utils.get(file_path).content).getElementsByTagName(tag_name)[0].toxml()).firstChild
 
 	obj_xml.firstChild.appendChild(elem)
 	return obj_xml.toxml()
@@ -265,7 +264,7 @@ def _url_exists(url_path):
 	:param url_path: 	The URL to check
 	:return: True if the URL exists, False otherwise
 	"""
-	return requests.get(url_path).status_code == 200
+	return http_utils.get(url_path).status_code == 200
 
 def quick_generate(project_folder, project_name, output_file,dataset_accession, sample_accession=None, study_accession=None, ega_run_accession=None, experiment_accession=None, analysis_accession=None,include_dataset=True):
 	"""
@@ -13,6 +13,10 @@ setup(name='icgconnect',
             'requests',
             'pysam'
       ],
+      extras_require={
+            'aio': ['aiohttp'],
+            'crypto': ['cryptography']
+      },
       zip_safe=True,
       test_suite='nose.collector',
       tests_require=['nose'])